@@ -0,0 +1,205 @@
+import argparse
+import asyncio
+import os
+import time
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from get_google_data import Google, SQL, Functions, Other, logger
+from reference_data import reference_data
+
+
+class RateLimiter:
+    """
+    Ограничение частоты запросов к API: не больше rate вызовов в секунду (0 - без ограничения).
+    """
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self) -> None:
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def month_starts(start: date, end: date) -> List[date]:
+    months = []
+    month = start.replace(day=1)
+    while month <= end:
+        months.append(month)
+        month = (month + timedelta(days=32)).replace(day=1)
+    return months
+
+
+async def publish_backfill(sql: SQL, touched: Dict[str, set]) -> None:
+    """
+    После загрузки истории пересчитывает сводку KPI за затронутые месяцы (куски ads и ga4 одного авто
+    писались параллельно) и увеличивает поколение данных, чтобы воркеры сбросили кэш страниц.
+    """
+    async with sql.pool.acquire() as conn:
+        for table_name, months in touched.items():
+            await sql.refresh_kpi_summary(conn, table_name, sorted(months))
+        _, generation = await sql.next_generation(conn)
+    logger.info(f"Сводка KPI пересчитана для {len(touched)} авто, поколение данных: {generation}")
+
+
+def split_range(start: date, end: date, chunk_days: int) -> List[Tuple[date, date]]:
+    chunks = []
+    chunk_start = start
+    while chunk_start <= end:
+        chunk_end = min(chunk_start + timedelta(days=chunk_days - 1), end)
+        chunks.append((chunk_start, chunk_end))
+        chunk_start = chunk_end + timedelta(days=1)
+    return chunks
+
+
+async def backfill(start: date, end: date, vehicles: Optional[List[str]] = None, sources: Tuple[str, ...] = ("ads", "ga4"),
+                   chunk_days: int = 30, job: Optional[str] = None, ads_concurrency: int = 3, ga_concurrency: int = 2,
+                   ads_rate: float = 5.0, ga_rate: float = 2.0) -> None:
+    """
+    Загрузка истории за период кусками по chunk_days дней. Куски выполняются параллельно в пределах
+    ограничений каждого API, готовые куски отмечаются в backfill_checkpoints - повторный запуск
+    с тем же job продолжает с места остановки.
+    """
+    google = Google()
+    sql = SQL()
+    functions = Functions()
+
+    job = job or f"{start.isoformat()}_{end.isoformat()}_{chunk_days}"
+    chunks = split_range(start, end, chunk_days)
+    wanted = {v.replace("-", "_") for v in vehicles} if vehicles else None
+
+    await sql.create_conn()
+    async with sql.pool.acquire() as conn:
+        await sql.ensure_backfill_checkpoints(conn)
+        done = await sql.get_done_chunks(conn, job)
+
+    def vehicle_of(campaign_name: str) -> Optional[str]:
+        target = reference_data.find_target(campaign_name)
+        if target is None:
+            return None
+        table_name = target["vehicle_name"].replace("-", "_")
+        if wanted is not None and table_name not in wanted:
+            return None
+        return table_name
+
+    stats = {"done": 0, "skipped": 0, "failed": 0}
+    # Месяцы, в которые записаны данные, по авто - для итогового пересчёта сводки KPI
+    touched: Dict[str, set] = {}
+
+    async def finish_chunk(source: str, account_id: str, chunk: Tuple[date, date], table_name: str,
+                           rows_written: int) -> None:
+        async with sql.pool.acquire() as conn:
+            await sql.mark_chunk_done(conn, job, source, account_id, chunk, table_name, rows_written)
+        stats["done"] += 1
+        touched.setdefault(table_name, set()).update(month_starts(*chunk))
+        logger.info(f'Backfill {source} "{table_name}" ({account_id}) {chunk[0]} - {chunk[1]}: {rows_written} дн.')
+
+    # Google Ads - потоковая запись пакетами (save_ads_stream)
+    ads_sem = asyncio.Semaphore(ads_concurrency)
+    ads_limiter = RateLimiter(ads_rate)
+
+    async def run_ads(sub_id: str, sub_name: str, table_name: str, chunk: Tuple[date, date]) -> None:
+        async with ads_sem:
+            await ads_limiter.wait()
+            try:
+                rows_written = await Other.save_ads_stream(google, functions, sub_id, sub_name,
+                                                           functions.build_traffic_query(*chunk), sql)
+            except Exception as e:
+                stats["failed"] += 1
+                logger.error(f"Backfill ads {sub_name} ({sub_id}) {chunk[0]} - {chunk[1]}: {e}")
+                return
+        await finish_chunk("ads", sub_id, chunk, table_name, rows_written)
+
+    # Google Analytics - один batchRunReports на кусок, запись через общий save_data
+    ga_sem = asyncio.Semaphore(ga_concurrency)
+    ga_limiter = RateLimiter(ga_rate)
+
+    async def run_ga(account: dict, table_name: str, chunk: Tuple[date, date]) -> None:
+        async with ga_sem:
+            await ga_limiter.wait()
+            try:
+                duration_temp, events_temp, traffic_temp = await google.get_analyst_batch(
+                    account['account_id'], start_date=chunk[0].isoformat(), end_date=chunk[1].isoformat()
+                )
+                info = {"campaign_name": account['account_name'], "campaign_id": account['account_id']}
+                failed = await Other.save_data([("duration", [{**info, "data": duration_temp}]),
+                                                ("events", [{**info, "data": events_temp}]),
+                                                ("traffic", [{**info, "data": traffic_temp}])], sql)
+                if failed:
+                    raise RuntimeError(failed[table_name])
+            except Exception as e:
+                stats["failed"] += 1
+                logger.error(f"Backfill ga4 {account['account_name']} ({account['account_id']}) "
+                             f"{chunk[0]} - {chunk[1]}: {e}")
+                return
+        await finish_chunk("ga4", account['account_id'], chunk, table_name, len(traffic_temp))
+
+    tasks = []
+    if "ads" in sources:
+        for sub in await google.get_sub_accounts():
+            sub_id = sub.customer_client.client_customer.removeprefix('customers/')
+            sub_name = sub.customer_client.descriptive_name or ""
+            table_name = vehicle_of(sub_name)
+            if sub_id == google.manager_id or table_name is None:
+                continue
+            for chunk in chunks:
+                if ("ads", sub_id, chunk[0]) in done:
+                    stats["skipped"] += 1
+                    continue
+                tasks.append(run_ads(sub_id, sub_name, table_name, chunk))
+
+    if "ga4" in sources:
+        for account in reference_data.analytic_accounts:
+            table_name = vehicle_of(account['account_name'])
+            if table_name is None:
+                continue
+            for chunk in chunks:
+                if ("ga4", account['account_id'], chunk[0]) in done:
+                    stats["skipped"] += 1
+                    continue
+                tasks.append(run_ga(account, table_name, chunk))
+
+    logger.info(f'Backfill "{job}": {len(tasks)} кусков к загрузке, {stats["skipped"]} уже загружено')
+    try:
+        await asyncio.gather(*tasks)
+        if touched:
+            await publish_backfill(sql, touched)
+    finally:
+        google.close()
+        await sql.close()
+
+    logger.info(f'Backfill "{job}" завершён: загружено {stats["done"]}, пропущено {stats["skipped"]}, '
+                f'с ошибкой {stats["failed"]}')
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Загрузка истории Google Ads и GA4 за период")
+    parser.add_argument("--start", required=True, type=date.fromisoformat, help="первая дата, YYYY-MM-DD")
+    parser.add_argument("--end", default=date.today() - timedelta(days=1), type=date.fromisoformat,
+                        help="последняя дата, YYYY-MM-DD (по умолчанию вчера)")
+    parser.add_argument("--vehicles", nargs="*", help="vehicle_name из target_names.json (по умолчанию все)")
+    parser.add_argument("--sources", nargs="*", choices=("ads", "ga4"), default=("ads", "ga4"))
+    parser.add_argument("--chunk-days", type=int, default=int(os.getenv("BACKFILL_CHUNK_DAYS", "30")))
+    parser.add_argument("--job", help="имя задачи для продолжения после остановки (по умолчанию из периода)")
+    parser.add_argument("--ads-concurrency", type=int, default=int(os.getenv("BACKFILL_ADS_CONCURRENCY", "3")))
+    parser.add_argument("--ga-concurrency", type=int, default=int(os.getenv("BACKFILL_GA_CONCURRENCY", "2")))
+    parser.add_argument("--ads-rate", type=float, default=float(os.getenv("BACKFILL_ADS_RATE", "5")),
+                        help="запросов Google Ads в секунду (0 - без ограничения)")
+    parser.add_argument("--ga-rate", type=float, default=float(os.getenv("BACKFILL_GA_RATE", "2")),
+                        help="запросов GA4 в секунду (0 - без ограничения)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    asyncio.run(backfill(start=args.start, end=args.end, vehicles=args.vehicles, sources=tuple(args.sources),
+                         chunk_days=args.chunk_days, job=args.job, ads_concurrency=args.ads_concurrency,
+                         ga_concurrency=args.ga_concurrency, ads_rate=args.ads_rate, ga_rate=args.ga_rate))
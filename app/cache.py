@@ -0,0 +1,88 @@
+import os
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional
+
+
+class GenerationCache:
+    """
+    Ограниченный LRU-кэш собранных данных страниц.
+    Ключ записи - (поколение обновления, ключ страницы). Поколение берётся из БД (sync) после каждого
+    сохранения данных, поэтому старые записи сразу перестают совпадать.
+    """
+    def __init__(self, max_size: int = 64):
+        self.max_size = max(1, max_size)
+        self.generation = 0
+        # Отличает ETag разных запусков процесса, пока поколение не загружено из БД (sync)
+        self.instance = uuid.uuid4().hex[:8]
+        self.hits = 0
+        self.misses = 0
+        self._items: OrderedDict = OrderedDict()
+        # Кэши с тем же поколением, но своим размером (см. link)
+        self._linked: List["GenerationCache"] = []
+
+    def link(self, cache: "GenerationCache") -> "GenerationCache":
+        """
+        Подключает кэш, который переходит на новое поколение вместе с этим и отдаёт те же ETag.
+        """
+        cache.instance, cache.generation = self.instance, self.generation
+        self._linked.append(cache)
+        return cache
+
+    def sync(self, instance: str, generation: int) -> bool:
+        """
+        Переход на общее поколение из БД (data_generation): у всех воркеров и реплик
+        одинаковые ETag. Возвращает True, если поколение сменилось и кэш сброшен.
+        """
+        changed = instance != self.instance or generation != self.generation
+        self.instance = instance
+        if changed:
+            self.generation = generation
+            self._items.clear()
+        for cache in self._linked:
+            cache.sync(instance, generation)
+        return changed
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        full_key = (self.generation, key)
+        value = self._items.get(full_key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._items.move_to_end(full_key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, generation: Optional[int] = None) -> None:
+        # Данные, собранные до завершения обновления, не должны попасть в новое поколение
+        if generation is None:
+            generation = self.generation
+        if generation != self.generation:
+            return
+        full_key = (generation, key)
+        self._items[full_key] = value
+        self._items.move_to_end(full_key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def etag(self, key: str, generation: Optional[int] = None) -> str:
+        if generation is None:
+            generation = self.generation
+        return f'W/"{self.instance}-{generation}-{key}"'
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "generation": self.generation,
+            "size": len(self._items),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+dashboard_cache = GenerationCache(max_size=int(os.getenv("DASHBOARD_CACHE_SIZE", "128")))
+# Записи по запросу клиента (месяцы трафика, полные версии exact) - отдельно, чтобы они
+# не вытесняли подготовленные prerender страницы и JSON
+ondemand_cache = dashboard_cache.link(GenerationCache(max_size=int(os.getenv("ONDEMAND_CACHE_SIZE", "64"))))
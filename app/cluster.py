@@ -0,0 +1,102 @@
+import asyncio
+import os
+from typing import Awaitable, Callable, Optional
+
+import asyncpg
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+from cache import dashboard_cache
+from get_google_data import SQL
+
+# Ключи advisory lock Postgres: ведущий процесс (cron) и само обновление данных
+SCHEDULER_LOCK_ID = int(os.getenv("SCHEDULER_LOCK_ID", "72630001"))
+REFRESH_LOCK_ID = int(os.getenv("REFRESH_LOCK_ID", "72630002"))
+# Как часто ведомые процессы пробуют стать ведущим и проверяют соединение
+LEADER_RETRY_SECONDS = float(os.getenv("LEADER_RETRY_SECONDS", "15"))
+
+
+class Cluster:
+    """
+    Несколько воркеров uvicorn и реплик на одной БД. Cron запускается только в ведущем процессе -
+    том, кто держит advisory lock SCHEDULER_LOCK_ID на отдельном соединении. Если ведущий
+    завершился, соединение закрывается, блокировка снимается и её забирает другой процесс.
+    По тому же соединению процесс слушает NOTIFY о новом поколении данных.
+    """
+    def __init__(self, scheduler: AsyncIOScheduler, on_generation: Callable[[int], Awaitable[None]]):
+        self.scheduler = scheduler
+        self.on_generation = on_generation
+        self.dsn = os.getenv("DB_CONNECT")
+        self.sql = SQL()
+        self.is_leader = False
+        self._conn: Optional[asyncpg.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+        self._generation_tasks: set = set()
+
+    async def start(self) -> None:
+        # Задачи cron добавлены, но выполняются только после избрания ведущим
+        self.scheduler.start(paused=True)
+        await self._connect(reconnect=False)
+        await self._try_lead()
+        self._task = asyncio.create_task(self._watch())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+        self.scheduler.shutdown(wait=False)
+        if self._conn is not None and not self._conn.is_closed():
+            # Закрытие соединения снимает блокировку - ведущим сразу может стать другой процесс
+            await self._conn.close()
+
+    async def _connect(self, reconnect: bool = True) -> None:
+        self._conn = await asyncpg.connect(dsn=self.dsn)
+        await self.sql.ensure_data_generation(self._conn)
+        await self.sql.ensure_refresh_jobs(self._conn)
+        await self._conn.add_listener(SQL.GENERATION_CHANNEL, self._on_notify)
+
+        # При запуске страницы готовит lifespan, после переподключения - on_generation:
+        # пока процесс был без соединения, данные могли обновиться
+        epoch, generation = await self.sql.get_generation(self._conn)
+        if dashboard_cache.sync(epoch, generation) and reconnect:
+            await self.on_generation(generation)
+
+    async def _try_lead(self) -> None:
+        if self.is_leader:
+            return
+        if await self._conn.fetchval("SELECT pg_try_advisory_lock($1);", SCHEDULER_LOCK_ID):
+            self.is_leader = True
+            self.scheduler.resume()
+            print(f"Процесс {os.getpid()} - ведущий, обновление по расписанию включено")
+
+    def _lose_lead(self) -> None:
+        if self.is_leader:
+            self.is_leader = False
+            self.scheduler.pause()
+            print(f"Процесс {os.getpid()} потерял соединение с БД, обновление по расписанию выключено")
+
+    async def _watch(self) -> None:
+        while True:
+            await asyncio.sleep(LEADER_RETRY_SECONDS)
+            try:
+                if self._conn.is_closed():
+                    self._lose_lead()
+                    await self._connect()
+                else:
+                    # Проверка соединения: обрыв замечается и без входящих NOTIFY
+                    await self._conn.execute("SELECT 1;")
+                await self._try_lead()
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+                self._lose_lead()
+                print(f"Ошибка соединения выбора ведущего: {e}")
+                if self._conn is not None and not self._conn.is_closed():
+                    self._conn.terminate()
+
+    def _on_notify(self, connection, pid, channel, payload) -> None:
+        try:
+            generation = int(payload)
+        except ValueError:
+            return
+        epoch = dashboard_cache.instance
+        if dashboard_cache.sync(epoch, generation):
+            task = asyncio.create_task(self.on_generation(generation))
+            self._generation_tasks.add(task)
+            task.add_done_callback(self._generation_tasks.discard)
@@ -2,259 +2,459 @@ import asyncio
 import json
 import os
 import re
+from contextlib import asynccontextmanager
 from datetime import datetime, date
 from dateutil.relativedelta import relativedelta
-from typing import Sequence, Any, Optional, List, Dict
+from typing import Sequence, Any, Optional, List, Dict, AsyncIterator
 
 import aiofiles
 import asyncpg
+import numpy as np
 from numpy import average
 from dotenv import load_dotenv
 load_dotenv()
 
+from reference_data import reference_data
+
 
 class Data:
-    def __init__(self):
+    # Графики кликов/длительности, события и трафик за месяц строятся по окну в три месяца
+    # (плюс TimeSeries.EVENT_COLUMNS)
+    WINDOW_COLUMNS = ("date", "clicks", "impressions", "duration")
+    # График трафика за всё время
+    HISTORY_COLUMNS = ("date", "total_users", "binotel_ct_call_details", "all_forms")
+
+    # Целевое число точек непрерывных графиков в /api/{vehicle}/dashboard
+    GRAPH_POINTS = dict.fromkeys(("clicks", "duration", "events"), int(os.getenv("DASHBOARD_GRAPH_POINTS", "120")))
+    # Сколько последних месяцев трафика за всё время отдаётся сразу
+    TRAFFIC_RECENT_MONTHS = int(os.getenv("TRAFFIC_RECENT_MONTHS", "2"))
+
+    def __init__(self, pool: Optional[asyncpg.Pool] = None):
         self.GOOGLE_ADS_CLICKS_PER_DAY_FILE = os.getenv("GOOGLE_ADS_CLICKS_PER_DAY_FILE")
         self.GOOGLE_ANALYST_DURATION_FILE = os.getenv("GOOGLE_ANALYST_DURATION_FILE")
         self.GOOGLE_ANALYST_EVENTS_FILE = os.getenv("GOOGLE_ANALYST_EVENTS_FILE")
         self.GOOGLE_ANALYST_TRAFFIC_FILE = os.getenv("GOOGLE_ANALYST_TRAFFIC_FILE")
-        self.TARGET_NAMES_FILE = os.getenv("TARGET_NAMES_FILE")
 
-        self.sql = SQL()
+        self.sql = SQL(pool=pool)
 
+        # data - окно последних трёх месяцев со всеми колонками виджетов,
+        # history - вся история только по колонкам графика трафика за всё время
         self.data = None
+        self.history = None
+        self.month_totals = None
+        self._aggregated = None
+
+    async def get_page_info(self, car_name: str) -> "TimeSeries":
+        """
+        Загружает данные страницы авто: каждый виджет получает только свои строки и колонки.
+        """
+        vehicle = self._vehicle_query(car_name)
+        today = datetime.today().date()
 
-    async def get_page_info(self, car_name: str) -> list:
-        data = await self.sql.get_data_from_table(table=car_name.replace("-", "_"))
-        for item in data:
-            item["date"] = item["date"].isoformat()
-        return data
-
-    async def get_top_info(self) -> Dict[str, Dict]:
-        path = self.TARGET_NAMES_FILE
-        if not path:
-            raise RuntimeError("TARGET_NAMES_FILE env var is not set")
+        window, history, totals = await asyncio.gather(
+            self.sql.get_data_from_table(**vehicle, columns=self.WINDOW_COLUMNS + TimeSeries.EVENT_COLUMNS,
+                                         date_from=today - relativedelta(months=3)),
+            self.sql.get_data_from_table(**vehicle, columns=self.HISTORY_COLUMNS),
+            self.sql.get_aggregate(**vehicle, aggregates={"clicks": "sum", "impressions": "sum"},
+                                   date_from=today.replace(day=1)),
+        )
 
-        async with aiofiles.open(path, mode="r", encoding="utf-8") as f:
-            raw = await f.read()
+        self.data = TimeSeries(window)
+        self.history = TimeSeries(history)
+        self.month_totals = totals[0] if totals else {}
+        self._aggregated = None
+        return self.data
 
-        try:
-            targets = json.loads(raw)
-        except json.JSONDecodeError:
-            print(f"Ошибка парсинга JSON файла: {path}")
-            return {}
+    def _vehicle_query(self, car_name: str) -> Dict[str, Any]:
+        # Данные всех авто лежат в daily_metrics, авто выбирается по company_name
+        return {"table": "daily_metrics", "where": self.sql.VEHICLE_WHERE, "params": (car_name.replace("-", "_"),)}
 
-        tables = [
-            t["vehicle_name"].replace("-", "_")
-            for t in targets
-            if isinstance(t, dict) and t.get("vehicle_name")
-        ]
+    async def get_top_info(self) -> Dict[str, Dict]:
+        tables = reference_data.get_vehicle_tables()
         if not tables:
             return {}
 
-        sql = SQL()
-
-        pool = await asyncpg.create_pool(dsn=sql.dsn, min_size=1, max_size=10, command_timeout=60)
-
-        sem = asyncio.Semaphore(10)
-
-        async def fetch_month(table: str):
-            async with sem:
-                try:
-                    async with pool.acquire() as conn:
-                        data = await sql.get_last_ctr_cost_cpc(conn, table)
-                        return table, data
-                except Exception as e:
-                    print(f"Ошибка получения верхних данных ({table}): {e}")
-                    return table, {}
-
-        results = await asyncio.gather(*(fetch_month(t) for t in tables))
+        month_start = date.today().replace(day=1)
+        try:
+            async with self.sql.connection() as conn:
+                rows = await self.sql.get_kpi_summary(conn, month_start)
+        except Exception as e:
+            print(f"Ошибка получения верхних данных: {e}")
+            rows = []
 
-        await pool.close()
-        return {table: data for table, data in results}
+        summary = {row["vehicle"]: row for row in rows}
+        empty = {"ctr": 0, "average_cpc": 0, "cost_micros": 0, "month_ctr": 0, "month_average_cpc": 0,
+                 "month_cost_micros": 0, "clicks": 0, "impressions": 0}
 
+        return {table: summary.get(table, empty) for table in tables}
 
-    async def get_additional_information(self):
-        now = datetime.now()
-        current_year = now.year
-        current_month = now.month
 
-        total_clicks = sum(
-            item['clicks']
-            for item in self.data
-            if datetime.strptime(item["date"], "%Y-%m-%d").year == current_year
-            and datetime.strptime(item["date"], "%Y-%m-%d").month == current_month
-        )
-        total_clicks = await Other.format_number(total_clicks)
+    @staticmethod
+    def _three_months_ago() -> np.datetime64:
+        return np.datetime64(datetime.today().date() - relativedelta(months=3), "D")
+
+    async def aggregate(self) -> Dict[str, Any]:
+        """
+        Все данные страницы за один проход по рядам авто: маски месяца и окна в три месяца,
+        итоги, шкалы графиков и колонки трафика считаются один раз, get_dashboard только выбирает точки.
+        """
+        if self._aggregated is not None:
+            return self._aggregated
+
+        series = self.data
+        # История загружается отдельно; если её нет - весь трафик строится по тем же данным
+        history = self.history if self.history is not None else series
+
+        three_months_ago = self._three_months_ago()
+        month_idx = np.flatnonzero(series.month_mask(datetime.now().date()))
+        window_idx = np.flatnonzero(series.dates >= three_months_ago)
+
+        total_clicks, total_impressions = await self._month_totals(month_idx)
+
+        self._aggregated = {
+            "totals": {"clicks": total_clicks, "impressions": total_impressions},
+            "window_idx": window_idx,
+            # Шкалы считаются по всем точкам окна, чтобы прореживание не меняло масштаб
+            "points": {"clicks": self._graph_points(series.column("clicks")[window_idx]),
+                       "duration": self._graph_points(series.column("duration")[window_idx]),
+                       "events": self._events_points(series.column("page_view")[window_idx])},
+            "traffic_current": (series.dates[month_idx],
+                                self._traffic_columns(series, month_idx, series.dates >= three_months_ago,
+                                                      reset_monthly=False)),
+            "traffic_all": (history.dates,
+                            self._traffic_columns(history, np.arange(len(history)), history.dates >= three_months_ago,
+                                                  reset_monthly=True)),
+        }
+        return self._aggregated
+
+    async def get_dashboard(self, exact: bool = False, points: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Серии страницы в колоночном виде (по массиву на поле) для /api/{vehicle}/dashboard.
+        Подписи дат строит клиент по массиву date. Без exact непрерывные графики прореживаются
+        до points (по умолчанию GRAPH_POINTS) точек, а трафик за всё время ограничен последними
+        TRAFFIC_RECENT_MONTHS месяцами (остальные - get_traffic_month).
+        """
+        aggregated = await self.aggregate()
+        series = self.data
+        window_idx = aggregated["window_idx"]
+
+        def sample(name: str) -> np.ndarray:
+            # Точки выбираются по основной серии графика, остальные колонки берутся в тех же датах
+            if exact:
+                return window_idx
+            target = points or self.GRAPH_POINTS[name]
+            values = series.column("page_view" if name == "events" else name)[window_idx]
+            return window_idx[TimeSeries.lttb_indices(values, target, series.dates[window_idx])]
+
+        clicks_idx, duration_idx, events_idx = sample("clicks"), sample("duration"), sample("events")
+        event_names = [name for name in TimeSeries.EVENT_COLUMNS if name in series.columns]
+
+        history_dates, history_columns = aggregated["traffic_all"]
+        history_months = history_dates.astype("datetime64[M]")
+        if exact:
+            keep, months = None, np.unique(history_months)
+        else:
+            months = np.datetime64(datetime.now().date(), "M") - np.arange(self.TRAFFIC_RECENT_MONTHS)[::-1]
+            keep = np.flatnonzero(history_months >= months[0])
+        traffic_all = self._columnar(history_dates, history_columns, keep)
+        # Месяцы, которые уже полностью есть в ответе - клиент не запрашивает их повторно
+        traffic_all["months"] = months.astype(str).tolist()
+
+        return {
+            "totals": dict(aggregated["totals"]),
+            "clicks": {"date": series.dates[clicks_idx].astype(str).tolist(),
+                       "v": series.column("clicks")[clicks_idx].tolist(),
+                       "imp": series.column("impressions")[clicks_idx].tolist(),
+                       "points": aggregated["points"]["clicks"]},
+            "duration": {"date": series.dates[duration_idx].astype(str).tolist(),
+                         "v": series.column("duration")[duration_idx].tolist(),
+                         "points": aggregated["points"]["duration"]},
+            "events": {"date": series.dates[events_idx].astype(str).tolist(),
+                       **{name: series.columns[name][events_idx].tolist() for name in event_names},
+                       "points": aggregated["points"]["events"]},
+            "traffic_current": self._columnar(*aggregated["traffic_current"]),
+            "traffic_all": traffic_all,
+        }
 
-        total_impressions = sum(
-            item["impressions"]
-            for item in self.data
-            if datetime.strptime(item["date"], "%Y-%m-%d").year == current_year
-            and datetime.strptime(item["date"], "%Y-%m-%d").month == current_month
+    async def get_first_date(self, car_name: str) -> Optional[date]:
+        rows = await self.sql.get_aggregate(**self._vehicle_query(car_name), aggregates={"date": "min"})
+        return rows[0]["date"] if rows else None
+
+    async def get_traffic_month(self, car_name: str, year: int, month: int) -> Dict[str, list]:
+        """
+        Точные дневные значения трафика за всё время для одного месяца (по запросу страницы).
+        Читаются только строки месяца и последняя строка перед ним: процент считается от предыдущего дня,
+        итоги с начала месяца сбрасываются каждый месяц, а звонки и заявки учитываются только в окне
+        трёх месяцев - значения совпадают с get_dashboard.
+        """
+        vehicle = self._vehicle_query(car_name)
+        month_start = date(year, month, 1)
+        previous, rows = await asyncio.gather(
+            self.sql.get_data_from_table(**vehicle, columns=self.HISTORY_COLUMNS,
+                                         date_to=month_start - relativedelta(days=1), limit=1),
+            self.sql.get_data_from_table(**vehicle, columns=self.HISTORY_COLUMNS, date_from=month_start,
+                                         date_to=month_start + relativedelta(months=1, days=-1)),
         )
-        total_impressions = await Other.format_number(total_impressions)
-
-        return total_clicks, total_impressions
-
-    async def chill_info(self, curr_info_name: str) -> (list, list):
-        today = datetime.today().date()
-        three_months_ago = today - relativedelta(months=3)
-        match curr_info_name:
-            case "clicks":
-                graph = [
-                    {
-                        "label": await Other.get_current_day(d["date"]),
-                        "v": d["clicks"],
-                        "imp": d["impressions"],
-                    }
-                    for d in self.data
-                    if datetime.strptime(d["date"], "%Y-%m-%d").date() >= three_months_ago
-                ]
-            case _:
-                graph = [
-                    {"label": await Other.get_current_day(d["date"]), "v": d[curr_info_name]}
-                    for d in self.data
-                    if datetime.strptime(d["date"], "%Y-%m-%d").date() >= three_months_ago
-                ]
-        points = [dur['v'] for dur in graph]
-        points = [int(min(points)) - 10 if min(points) - 10 >= 0 else 0,
-                          int(average(points)), int(max(points)) + 10]
-        return graph, points
-
-    async def get_events(self):
-        today = datetime.today().date()
-        three_months_ago = today - relativedelta(months=3)
-
-        events_by_date = {}
-
-        for d in self.data:
-            if datetime.strptime(d["date"], "%Y-%m-%d").date() >= three_months_ago:
-                for d_key, d_val in d.items():
-                    if d_key not in ('page_view', 'session_start', 'user_engagement', 'first_visit', 'view_item',
-                                     'click', 'get_call', 'scroll', 'form_start', 'all_forms', 'binotel_ct_call_details',
-                                     'binotel_ct_call_received', 'total_users', 'G-MSGH2BB72V', 'G-3WLWZYJN52', 'G-EKMR3T60Q4'):
-                        continue
-                    date_str = d["date"]
-                    name = d_key
-                    count = int(d_val or 0)
-
-                    if date_str not in events_by_date:
-                        events_by_date[date_str] = {"date": date_str}
 
-                    events_by_date[date_str][name] = count
-
-        events_graph = []
-        for date_str, row in events_by_date.items():
-            row = dict(row)
-            row["label"] = await Other.get_current_day(date_str)
-            events_graph.append(row)
-
-        events_graph.sort(key=lambda x: x["date"])
-
-        events_graph_points = [e.get("page_view", 0) for e in events_graph]
-        events_graph_points = [0, int(average(events_graph_points)), max(events_graph_points) + 10]
-
-        return events_graph, events_graph_points, events_by_date
+        series = TimeSeries(previous + rows)
+        keep = np.arange(len(previous), len(series))
+        columns = self._traffic_columns(series, np.arange(len(series)), series.dates >= self._three_months_ago(),
+                                        reset_monthly=True)
+        return self._columnar(series.dates, columns, keep)
+
+    async def _month_totals(self, month_idx: np.ndarray) -> (str, str):
+        # Итоги за месяц считает БД; без них (данные переданы напрямую) - по окну
+        if self.month_totals is not None:
+            clicks = self.month_totals.get("clicks") or 0
+            impressions = self.month_totals.get("impressions") or 0
+        else:
+            clicks = self.data.column("clicks")[month_idx].sum()
+            impressions = self.data.column("impressions")[month_idx].sum()
+        return await Other.format_number(int(clicks)), await Other.format_number(int(impressions))
 
-    async def get_traffic(self, events_by_date:dict, is_all: bool = False):
-        now = datetime.now()
-        current_year = now.year
-        current_month = now.month
+    @staticmethod
+    def _graph_points(values: np.ndarray) -> list:
+        if not values.size:
+            return [0, 0, 10]
+        return [int(values.min()) - 10 if values.min() - 10 >= 0 else 0,
+                int(average(values)), int(values.max()) + 10]
 
-        if is_all:
-            traffic_graph = [
-                {"date": d["date"], "label": await Other.get_current_day(d["date"]), "v": int(d["total_users"])}
-                for d in self.data
-            ]
-        else:
-            traffic_graph = [
-                {"date": d["date"], "label": await Other.get_current_day(d["date"]), "v": int(d["total_users"])}
-                for d in self.data
-                if datetime.strptime(d["date"], "%Y-%m-%d").year == current_year
-                   and datetime.strptime(d["date"], "%Y-%m-%d").month == current_month
-            ]
+    @staticmethod
+    def _events_points(page_views: np.ndarray) -> list:
+        if not page_views.size:
+            return [0, 0, 10]
+        return [0, int(average(page_views)), int(page_views.max()) + 10]
 
-        traffic_graph.sort(key=lambda x: x["date"])
+    @staticmethod
+    def _traffic_columns(series: "TimeSeries", idx: np.ndarray, in_events: np.ndarray,
+                         reset_monthly: bool) -> Dict[str, np.ndarray]:
+        dates = series.dates[idx]
+        users = series.column("total_users")[idx].astype(np.int64)
+
+        # Процент относительно предыдущего дня (0, если предыдущего дня нет или он нулевой)
+        prev = np.concatenate(([0], users[:-1])).astype(np.float64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            percent = np.where(prev == 0, 0.0, ((prev - users) / prev * 100) * -1)
+
+        # Звонки и заявки берутся только из окна событий (последние три месяца), как в get_events
+        calls = np.where(in_events[idx], series.column("binotel_ct_call_details")[idx], 0).astype(np.int64)
+        forms = np.where(in_events[idx], series.column("all_forms")[idx], 0).astype(np.int64)
+
+        return {
+            "users": users,
+            "percent": percent,
+            "calls": calls,
+            "calls_mtd": TimeSeries.running_total(calls, dates if reset_monthly else None),
+            "forms": forms,
+            "forms_mtd": TimeSeries.running_total(forms, dates if reset_monthly else None),
+        }
 
-        traffic_graph_percent = []
-        prev = None
+    @staticmethod
+    def _columnar(dates: np.ndarray, columns: Dict[str, np.ndarray],
+                  keep: Optional[np.ndarray] = None) -> Dict[str, list]:
+        # keep - позиции, которые попадут в ответ (расчёт колонок уже сделан по всему ряду)
+        if keep is not None:
+            dates = dates[keep]
+            columns = {name: values[keep] for name, values in columns.items()}
+        return {"date": dates.astype(str).tolist(), **{name: values.tolist() for name, values in columns.items()}}
+
+
+class TimeSeries:
+    """
+    Колонки таблицы авто в виде массивов: даты - datetime64[D], метрики - int64/float64.
+    Строки отсортированы по дате.
+    """
+    FLOAT_COLUMNS = ("duration", "ctr", "cost_micros", "average_cpc")
+    EVENT_COLUMNS = ('page_view', 'session_start', 'user_engagement', 'first_visit', 'view_item', 'click', 'get_call',
+                     'scroll', 'form_start', 'all_forms', 'binotel_ct_call_details', 'binotel_ct_call_received',
+                     'total_users')
+    SKIP_COLUMNS = ("vehicle_id", "date", "created_at")
+
+    def __init__(self, rows: List[Dict[str, Any]]):
+        dates = np.array([row["date"] for row in rows], dtype="datetime64[D]")
+        order = np.argsort(dates, kind="stable")
+        self.dates = dates[order]
+
+        self.columns: Dict[str, np.ndarray] = {}
+        for name in (rows[0].keys() if rows else ()):
+            if name in self.SKIP_COLUMNS:
+                continue
+            dtype = np.float64 if name in self.FLOAT_COLUMNS else np.int64
+            self.columns[name] = np.array([row[name] or 0 for row in rows], dtype=dtype)[order]
+
+    def __len__(self) -> int:
+        return len(self.dates)
+
+    def column(self, name: str) -> np.ndarray:
+        if name in self.columns:
+            return self.columns[name]
+        dtype = np.float64 if name in self.FLOAT_COLUMNS else np.int64
+        return np.zeros(len(self.dates), dtype=dtype)
+
+    def month_mask(self, day: date) -> np.ndarray:
+        return self.dates.astype("datetime64[M]") == np.datetime64(day, "M")
 
-        calls_mtd = 0
-        forms_mtd = 0
-        prev_month_key = None
+    @staticmethod
+    def lttb_indices(values: np.ndarray, target: int, dates: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Прореживание Largest-Triangle-Three-Buckets: первая и последняя точки сохраняются,
+        из каждой промежуточной корзины берётся точка, образующая наибольший треугольник
+        с уже выбранной точкой и средним следующей корзины. Возвращает индексы точек.
+        """
+        n = len(values)
+        if target >= n or target < 3:
+            return np.arange(n)
+
+        y = values.astype(np.float64)
+        x = dates.astype("datetime64[D]").astype(np.float64) if dates is not None else np.arange(n, dtype=np.float64)
+
+        # target - 2 корзины между первой и последней точкой
+        edges = np.linspace(1, n - 1, target - 1).astype(np.int64)
+        selected = np.empty(target, dtype=np.int64)
+        selected[0], selected[-1] = 0, n - 1
+
+        prev = 0
+        for bucket in range(target - 2):
+            start, end = edges[bucket], edges[bucket + 1]
+            next_start, next_end = (end, edges[bucket + 2]) if bucket + 2 < len(edges) else (n - 1, n)
+            avg_x, avg_y = x[next_start:next_end].mean(), y[next_start:next_end].mean()
+
+            area = np.abs((x[prev] - avg_x) * (y[start:end] - y[prev]) - (x[prev] - x[start:end]) * (avg_y - y[prev]))
+            prev = start + int(area.argmax())
+            selected[bucket + 1] = prev
+        return selected
 
-        for point in traffic_graph:
-            date_str = point["date"]
-            cur = point["v"]
+    @staticmethod
+    def running_total(values: np.ndarray, dates: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Нарастающий итог; если переданы даты - со сбросом в начале каждого месяца.
+        """
+        totals = np.cumsum(values)
+        if dates is None or not len(values):
+            return totals
 
-            if prev is None or prev == 0:
-                percent_v = 0
-            else:
-                percent_v = ((prev - cur) / prev * 100) * -1
-            prev = cur
+        months = dates.astype("datetime64[M]")
+        starts = np.concatenate(([True], months[1:] != months[:-1]))
+        start_idx = np.maximum.accumulate(np.where(starts, np.arange(len(values)), 0))
+        return totals - totals[start_idx] + values[start_idx]
 
-            if is_all:
-                month_key = date_str[:7]  # "YYYY-MM"
-                if prev_month_key is None or month_key != prev_month_key:
-                    calls_mtd = 0
-                    forms_mtd = 0
-                    prev_month_key = month_key
 
-            ev = events_by_date.get(date_str, {})
+class SQL:
+    VEHICLE_WHERE = "vehicle_id = (SELECT id FROM companies WHERE company_name = $1)"
+    AGGREGATES = ("sum", "avg", "min", "max", "count")
+    PERIODS = ("day", "week", "month")
 
-            calls_day = int(ev.get("binotel_ct_call_details", 0) or 0) + int(ev.get("Get_call", 0) or 0)
-            forms_day = int(ev.get("all_forms", 0) or 0)
+    def __init__(self, pool: Optional[asyncpg.Pool] = None):
+        self.dsn = os.getenv("DB_CONNECT")
+        self.pool = pool
+        self.VALID_TABLE_RE = re.compile(r"^[a-zA-Z_][a-zA-Z0-9_]*$")
 
-            calls_mtd += calls_day
-            forms_mtd += forms_day
+    @staticmethod
+    def pool_max_size() -> int:
+        return int(os.getenv("DB_POOL_MAX_SIZE", "10"))
 
-            traffic_graph_percent.append({
-                "date": date_str,
-                "label": point["label"],
-                "v": percent_v,
+    @staticmethod
+    async def create_pool(dsn: Optional[str] = None) -> asyncpg.Pool:
+        """
+        Общий пул соединений приложения. Создаётся один раз в lifespan (main.py).
+        """
+        return await asyncpg.create_pool(
+            dsn=dsn or os.getenv("DB_CONNECT"),
+            min_size=int(os.getenv("DB_POOL_MIN_SIZE", "1")),
+            max_size=SQL.pool_max_size(),
+            command_timeout=float(os.getenv("DB_COMMAND_TIMEOUT", "60")),
+        )
 
-                "Звонки": calls_day,
-                "Звонки с начала месяца": calls_mtd,
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[asyncpg.Connection]:
+        # Без общего пула (например, при запуске вне FastAPI) открываем разовое соединение
+        if self.pool is not None:
+            async with self.pool.acquire() as conn:
+                yield conn
+            return
 
-                "Заявки": forms_day,
-                "Заявки с начала месяца": forms_mtd,
+        conn = await asyncpg.connect(self.dsn)
+        try:
+            yield conn
+        finally:
+            await conn.close()
 
-                "Общая конверсия": calls_mtd + forms_mtd
-            })
-        return traffic_graph, traffic_graph_percent
+    @staticmethod
+    def _columns_sql(columns: Sequence[str]) -> str:
+        if tuple(columns) == ("*",):
+            return "*"
+        safe_cols = []
+        for c in columns:
+            if not c.replace("_", "").isalnum():
+                raise ValueError(f"Unsafe column name: {c}")
+            safe_cols.append(f'"{c}"')
+        return ", ".join(safe_cols)
 
-class SQL:
-    def __init__(self):
-        self.dsn = os.getenv("DB_CONNECT")
-        self.VALID_TABLE_RE = re.compile(r"^[a-zA-Z_][a-zA-Z0-9_]*$")
+    @staticmethod
+    def _where_sql(where: str, params: Sequence[Any], date_from: Optional[date],
+                   date_to: Optional[date]) -> (str, list):
+        # Границы окна дат добавляются параметрами после переданных params
+        conditions = [f"({where})"] if where else []
+        params = list(params)
+        if date_from is not None:
+            params.append(date_from)
+            conditions.append(f"date >= ${len(params)}")
+        if date_to is not None:
+            params.append(date_to)
+            conditions.append(f"date <= ${len(params)}")
+        return (f" WHERE {' AND '.join(conditions)}" if conditions else ""), params
 
     async def get_data_from_table(self, table: str, columns: Sequence[str] = ("*",), where: str = "",
-                                      params: Sequence[Any] = (), limit: Optional[int] = 1000) -> List[Dict[str, Any]]:
-        if columns == ("*",) or columns == ["*"]:
-            cols_sql = "*"
+                                  params: Sequence[Any] = (), date_from: Optional[date] = None,
+                                  date_to: Optional[date] = None, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Строки таблицы за окно дат [date_from, date_to] только с нужными колонками, по возрастанию даты.
+        limit оставляет самые свежие дни.
+        """
+        table = self._sanitize_table_name(table)
+        cols_sql = self._columns_sql(columns)
+        where_sql, params = self._where_sql(where, params, date_from, date_to)
+
+        if limit is not None:
+            sql = f"SELECT {cols_sql} FROM {table}{where_sql} ORDER BY date DESC LIMIT {int(limit)};"
         else:
-            safe_cols = []
-            for c in columns:
-                if not c.replace("_", "").isalnum():
-                    raise ValueError(f"Unsafe column name: {c}")
-                safe_cols.append(f'"{c}"')
-            cols_sql = ", ".join(safe_cols)
+            sql = f"SELECT {cols_sql} FROM {table}{where_sql} ORDER BY date;"
 
-        where_sql = f" WHERE {where}" if where else ""
-        limit_sql = f" LIMIT {int(limit)}" if limit is not None else ""
+        async with self.connection() as conn:
+            rows = await conn.fetch(sql, *params)
 
-        sql = f"SELECT {cols_sql} FROM {table}{where_sql} ORDER BY date {limit_sql};"
+        result = [dict(r) for r in rows]
+        if limit is not None:
+            result.reverse()
+        return result
+
+    async def get_aggregate(self, table: str, aggregates: Dict[str, str], where: str = "",
+                            params: Sequence[Any] = (), date_from: Optional[date] = None,
+                            date_to: Optional[date] = None, period: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Агрегаты на стороне БД: aggregates - {колонка: sum/avg/min/max/count}.
+        Без period - одна строка за всё окно, с period (day/week/month) - строка на период в колонке date.
+        """
+        table = self._sanitize_table_name(table)
+        select = []
+        for column, func in aggregates.items():
+            if func.lower() not in self.AGGREGATES:
+                raise ValueError(f"Unsupported aggregate: {func}")
+            select.append(f'{func.upper()}({self._columns_sql((column,))}) AS "{column}"')
+        where_sql, params = self._where_sql(where, params, date_from, date_to)
+
+        if period is not None:
+            if period not in self.PERIODS:
+                raise ValueError(f"Unsupported period: {period}")
+            bucket = f"date_trunc('{period}', date)::date"
+            sql = (f"SELECT {bucket} AS date, {', '.join(select)} FROM {table}{where_sql} "
+                   f"GROUP BY 1 ORDER BY 1;")
+        else:
+            sql = f"SELECT {', '.join(select)} FROM {table}{where_sql};"
 
-        conn: Optional[asyncpg.Connection] = None
-        try:
-            conn = await asyncpg.connect(self.dsn)
+        async with self.connection() as conn:
             rows = await conn.fetch(sql, *params)
-            return [dict(r) for r in rows]
-        finally:
-            if conn is not None:
-                await conn.close()
+        return [dict(r) for r in rows]
 
     def _sanitize_table_name(self, table: str) -> str:
         # строго: только безопасные идентификаторы
@@ -262,41 +462,29 @@ class SQL:
             raise ValueError(f"Unsafe table name: {table!r}")
         return table
 
-    async def get_last_ctr_cost_cpc(
-            self,
-            conn: asyncpg.Connection,
-            table: str
-    ) -> List:
-
-        now = datetime.now()
-        current_year = now.year
-        current_month = now.month
-
-        # начало текущего месяца
-        start_date = date(current_year, current_month, 1)
-
-        # начало следующего месяца
-        if current_month == 12:
-            end_date = date(current_year + 1, 1, 1)
-        else:
-            end_date = date(current_year, current_month + 1, 1)
-
-        table = self._sanitize_table_name(table)
-
-        table = await conn.fetch(
-            f"""
-            SELECT ctr, cost_micros, average_cpc
-            FROM {table}
-            WHERE date >= $1
-              AND date < $2
-            ORDER BY date DESC
-            LIMIT 32
+    async def get_kpi_summary(self, conn: asyncpg.Connection, month_start: date) -> List[Dict[str, Any]]:
+        """
+        Сводка по всем авто за месяц одним запросом (таблицу ведёт загрузка в get_google_data).
+        ctr/average_cpc/cost_micros - значения за последний день, month_* - за месяц.
+        """
+        rows = await conn.fetch(
+            """
+            SELECT vehicle,
+                   last_ctr  AS ctr,
+                   last_cpc  AS average_cpc,
+                   last_cost AS cost_micros,
+                   ctr       AS month_ctr,
+                   cpc       AS month_average_cpc,
+                   cost      AS month_cost_micros,
+                   clicks,
+                   impressions
+            FROM vehicle_kpi_summary
+            WHERE month = $1
             """,
-            start_date,
-            end_date
+            month_start
         )
 
-        return [dict(row) for row in table] if table else {}
+        return [dict(row) for row in rows]
 
 
 class Other:
@@ -326,22 +514,3 @@ class Other:
             s = s[:-3]
 
         return ' '.join(reversed(parts))
-
-    @staticmethod
-    async def get_current_day(date: str) -> str:
-        days_of_week = {
-            "0": "пн",
-            "1": "вт",
-            "2": "ср",
-            "3": "чт",
-            "4": "пт",
-            "5": "сб.",
-            "6": "вс."
-        }
-        months = await Other.get_data(os.getenv("MONTH_FILE"))
-        day = ''
-        d = datetime.strptime(date, "%Y-%m-%d")
-        day += f'{days_of_week[str(d.weekday())]} '
-        day += f'{d.day} '
-        day += months.get(str(d.month))
-        return day
@@ -3,14 +3,17 @@ import logging
 import os
 import asyncio
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing
 from datetime import date, timedelta, datetime
-from typing import Optional, List, Dict, Tuple
+from typing import Optional, List, Dict, Tuple, AsyncIterator
 
 from google.ads.googleads.client import GoogleAdsClient
 
 from google.analytics.data_v1beta import BetaAnalyticsDataClient
 from google.analytics.data_v1beta.types import (DateRange, Metric, RunReportRequest, Dimension, OrderBy, Filter,
-                                                FilterExpression)
+                                                FilterExpression, BatchRunReportsRequest)
 from google.oauth2.credentials import Credentials
 
 from dotenv import load_dotenv
@@ -18,6 +21,9 @@ import aiofiles
 
 import asyncpg
 
+from cache import dashboard_cache
+from reference_data import reference_data
+
 load_dotenv()
 
 class ColorFormatter(logging.Formatter):
@@ -66,6 +72,18 @@ class Google:
         )
         self.analytics_client = BetaAnalyticsDataClient(credentials=self.analytics_credentials)
 
+        # Клиент GA4 синхронный - отчёты выполняются в отдельном пуле потоков, а не в цикле событий
+        self.analytics_concurrency = int(os.getenv("ANALYTICS_CONCURRENCY", "4"))
+        self.analytics_executor = ThreadPoolExecutor(max_workers=self.analytics_concurrency,
+                                                     thread_name_prefix="ga4")
+
+    async def run_report(self, request: RunReportRequest):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.analytics_executor, self.analytics_client.run_report, request)
+
+    def close(self) -> None:
+        self.analytics_executor.shutdown(wait=False)
+
     async def gaql_async(self, customer_id: str, query: str):
         def _run():
             service = self.ads_client.get_service(self.service_name)
@@ -77,6 +95,50 @@ class Google:
 
         return await asyncio.to_thread(_run)
 
+    async def gaql_stream(self, customer_id: str, query: str, queue_size: int = 4) -> AsyncIterator[list]:
+        """
+        Потоковый GAQL через search_stream: пакеты строк отдаются по мере поступления.
+        Очередь ограничена, поэтому поток чтения ждёт, пока потребитель (запись в БД) не заберёт пакет.
+        """
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        stopped = threading.Event()
+        done = object()
+
+        def _put(item) -> None:
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        def _run():
+            try:
+                service = self.ads_client.get_service(self.service_name)
+                stream = service.search_stream(customer_id=customer_id, query=query)
+                for batch in stream:
+                    if stopped.is_set():
+                        return
+                    _put(list(batch.results))
+            except Exception as e:
+                _put(e)
+            finally:
+                if not stopped.is_set():
+                    _put(done)
+
+        reader = loop.run_in_executor(None, _run)
+        try:
+            while True:
+                item = await queue.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # Потребитель мог остановиться раньше - освобождаем очередь, чтобы поток чтения завершился
+            stopped.set()
+            while not reader.done():
+                while not queue.empty():
+                    queue.get_nowait()
+                await asyncio.sleep(0.05)
+
     async def get_sub_accounts(self):
         query = """
                 SELECT
@@ -86,10 +148,11 @@ class Google:
                 """
         return await self.gaql_async(self.manager_id, query)
 
-    async def get_analyst_data(self, property_id: str) -> list:
-        request = RunReportRequest(
+    @staticmethod
+    def duration_request(property_id: str, start_date: str = "yesterday", end_date: str = "today") -> RunReportRequest:
+        return RunReportRequest(
             property=f"properties/{property_id}",
-            date_ranges=[DateRange(start_date="yesterday", end_date="today")],
+            date_ranges=[DateRange(start_date=start_date, end_date=end_date)],
             dimensions=[Dimension(name="date")],
             metrics=[Metric(name="averageSessionDuration")],
             order_bys=[
@@ -101,8 +164,8 @@ class Google:
             ],
         )
 
-        response = self.analytics_client.run_report(request)
-
+    @staticmethod
+    def parse_duration(response) -> List[Dict]:
         result = []
         for row in response.rows:
             click_date = datetime.strptime(
@@ -115,66 +178,67 @@ class Google:
 
         return result
 
-    async def get_analyst_events(self, property_id: str, include_date: bool = True, event_names: Optional[List[str]] = None,
-                limit: int = 10000) -> List[Dict]:
-            dims = []
-            if include_date:
-                dims.append(Dimension(name="date"))
-            dims.append(Dimension(name="eventName"))
-
-            metrics = [Metric(name="eventCount")]
-
-            dimension_filter = None
-            if event_names:
-                from google.analytics.data_v1beta.types import FilterExpression, Filter, InListFilter
-
-                dimension_filter = FilterExpression(
-                    filter=Filter(
-                        field_name="eventName",
-                        in_list_filter=InListFilter(values=event_names),
-                    )
+    @staticmethod
+    def events_request(property_id: str, include_date: bool = True, event_names: Optional[List[str]] = None,
+                       limit: int = 10000, start_date: str = "yesterday", end_date: str = "today") -> RunReportRequest:
+        dims = []
+        if include_date:
+            dims.append(Dimension(name="date"))
+        dims.append(Dimension(name="eventName"))
+
+        metrics = [Metric(name="eventCount")]
+
+        dimension_filter = None
+        if event_names:
+            from google.analytics.data_v1beta.types import FilterExpression, Filter, InListFilter
+
+            dimension_filter = FilterExpression(
+                filter=Filter(
+                    field_name="eventName",
+                    in_list_filter=InListFilter(values=event_names),
                 )
-
-            order_bys = []
-            if include_date:
-                order_bys.append(OrderBy(dimension=OrderBy.DimensionOrderBy(dimension_name="date")))
-            order_bys.append(OrderBy(metric=OrderBy.MetricOrderBy(metric_name="eventCount"), desc=True))
-
-            request = RunReportRequest(
-                property=f"properties/{property_id}",
-                date_ranges=[DateRange(start_date="yesterday", end_date="today")],
-                dimensions=dims,
-                metrics=metrics,
-                dimension_filter=dimension_filter,
-                order_bys=order_bys,
-                limit=limit,
             )
 
-            response = self.analytics_client.run_report(request)
+        order_bys = []
+        if include_date:
+            order_bys.append(OrderBy(dimension=OrderBy.DimensionOrderBy(dimension_name="date")))
+        order_bys.append(OrderBy(metric=OrderBy.MetricOrderBy(metric_name="eventCount"), desc=True))
+
+        return RunReportRequest(
+            property=f"properties/{property_id}",
+            date_ranges=[DateRange(start_date=start_date, end_date=end_date)],
+            dimensions=dims,
+            metrics=metrics,
+            dimension_filter=dimension_filter,
+            order_bys=order_bys,
+            limit=limit,
+        )
 
-            results: List[Dict] = []
-            for row in response.rows:
-                idx = 0
-                date_iso = None
+    @staticmethod
+    def parse_events(response, include_date: bool = True) -> List[Dict]:
+        results: List[Dict] = []
+        for row in response.rows:
+            idx = 0
+            date_iso = None
 
-                if include_date:
-                    raw_date = row.dimension_values[idx].value  # YYYYMMDD
-                    date_iso = datetime.strptime(raw_date, "%Y%m%d").date().isoformat()
-                    idx += 1
+            if include_date:
+                raw_date = row.dimension_values[idx].value  # YYYYMMDD
+                date_iso = datetime.strptime(raw_date, "%Y%m%d").date().isoformat()
+                idx += 1
 
-                event_name = row.dimension_values[idx].value
-                event_count = int(float(row.metric_values[0].value))
+            event_name = row.dimension_values[idx].value
+            event_count = int(float(row.metric_values[0].value))
 
-                if include_date:
-                    results.append({"date": date_iso, "eventName": event_name, "eventCount": event_count})
-                else:
-                    results.append({"eventName": event_name, "eventCount": event_count})
+            if include_date:
+                results.append({"date": date_iso, "eventName": event_name, "eventCount": event_count})
+            else:
+                results.append({"eventName": event_name, "eventCount": event_count})
 
-            return results
+        return results
 
-    async def get_analyst_traffic(self, property_id: str, start_date: str = "yesterday",
-            end_date: str = "today") -> List[Dict]:
-        request = RunReportRequest(
+    @staticmethod
+    def traffic_request(property_id: str, start_date: str = "yesterday", end_date: str = "today") -> RunReportRequest:
+        return RunReportRequest(
             property=f"properties/{property_id}",
             date_ranges=[DateRange(start_date=start_date, end_date=end_date)],
             dimensions=[Dimension(name="date")],
@@ -182,8 +246,8 @@ class Google:
             order_bys=[OrderBy(dimension=OrderBy.DimensionOrderBy(dimension_name="date"))],
         )
 
-        response = self.analytics_client.run_report(request)
-
+    @staticmethod
+    def parse_traffic(response) -> List[Dict]:
         result: List[Dict] = []
         for row in response.rows:
             raw_date = row.dimension_values[0].value
@@ -194,11 +258,114 @@ class Google:
 
         return result
 
+    async def get_analyst_data(self, property_id: str) -> list:
+        response = await self.run_report(self.duration_request(property_id))
+        return self.parse_duration(response)
+
+    async def get_analyst_events(self, property_id: str, include_date: bool = True, event_names: Optional[List[str]] = None,
+                limit: int = 10000) -> List[Dict]:
+        request = self.events_request(property_id, include_date=include_date, event_names=event_names, limit=limit)
+        response = await self.run_report(request)
+        return self.parse_events(response, include_date=include_date)
+
+    async def get_analyst_traffic(self, property_id: str, start_date: str = "yesterday",
+            end_date: str = "today") -> List[Dict]:
+        response = await self.run_report(self.traffic_request(property_id, start_date=start_date, end_date=end_date))
+        return self.parse_traffic(response)
+
+    async def get_analyst_batch(self, property_id: str, start_date: str = "yesterday",
+                                end_date: str = "today") -> Tuple[List[Dict], List[Dict], List[Dict]]:
+        """
+        Длительность, события и трафик ресурса одним batchRunReports вместо трёх runReport.
+        Отчёты в ответе идут в том же порядке, что и в запросе.
+        """
+        request = BatchRunReportsRequest(
+            property=f"properties/{property_id}",
+            requests=[
+                self.duration_request(property_id, start_date=start_date, end_date=end_date),
+                self.events_request(property_id, start_date=start_date, end_date=end_date),
+                self.traffic_request(property_id, start_date=start_date, end_date=end_date),
+            ],
+        )
+
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(self.analytics_executor, self.analytics_client.batch_run_reports,
+                                              request)
+        duration_report, events_report, traffic_report = response.reports
+
+        return (self.parse_duration(duration_report), self.parse_events(events_report),
+                self.parse_traffic(traffic_report))
+
+
+class SchemaCache:
+    """
+    Кэш схемы на время жизни процесса: список таблиц БД (включая секции daily_metrics)
+    и разрешённые аккаунты (campaign_name, campaign_id) -> (id в companies, ключ авто).
+    Разрешённые аккаунты сбрасываются при изменении target_names.json, всё - после ошибки записи.
+    """
+    def __init__(self):
+        self.tables: Optional[set] = None
+        # Каталог перечитывается при следующей проверке; сам набор не обнуляется, пока с ним работают ensure_*
+        self.stale = False
+        self.resolved: Dict[Tuple[str, str], Tuple[int, str]] = {}
+        self.targets_version: Optional[int] = None
+        # Таблицы и секции daily_metrics создаются по одной, даже если авто пишутся параллельно
+        self.lock = asyncio.Lock()
+
+    def check_targets(self, version: int) -> None:
+        if version != self.targets_version:
+            self.resolved.clear()
+            self.targets_version = version
+
+    def invalidate(self) -> None:
+        self.stale = True
+        self.resolved.clear()
+
+    def add_table(self, table_name: str) -> None:
+        if self.tables is not None:
+            self.tables.add(table_name)
+
+    def discard_table(self, table_name: str) -> None:
+        if self.tables is not None:
+            self.tables.discard(table_name)
+
+
+schema_cache = SchemaCache()
+
 
 class SQL:
+    METRIC_COLUMNS = {
+        "clicks": "INTEGER",
+        "impressions": "INTEGER",
+        "duration": "DOUBLE PRECISION",
+        "page_view": "INTEGER",
+        "session_start": "INTEGER",
+        "user_engagement": "INTEGER",
+        "first_visit": "INTEGER",
+        "view_item": "INTEGER",
+        "click": "INTEGER",
+        "get_call": "INTEGER",
+        "scroll": "INTEGER",
+        "form_start": "INTEGER",
+        "g_msgh2bb72v": "INTEGER",
+        "g_3wlwzyjn52": "INTEGER",
+        "g_ekmr3t60q4": "INTEGER",
+        "all_forms": "INTEGER",
+        "binotel_ct_call_details": "INTEGER",
+        "binotel_ct_call_received": "INTEGER",
+        "total_users": "INTEGER",
+        "ctr": "DOUBLE PRECISION",
+        "cost_micros": "DOUBLE PRECISION",
+        "average_cpc": "DOUBLE PRECISION",
+    }
+
+    # Канал NOTIFY, по которому процессы узнают о новом поколении данных (см. cluster.py)
+    GENERATION_CHANNEL = "data_generation"
+
     def __init__(self):
         self.dsn = os.getenv("DB_CONNECT")
         self.pool = None
+        self.upsert_queries: Dict[Tuple[str, ...], str] = {}
 
     async def create_conn(self):
         if self.pool is None:
@@ -215,65 +382,489 @@ class SQL:
         """
         Проверяем существование таблиц и создаём, если их нет.
         """
-        targets = await Other.get_data(os.getenv("TARGET_NAMES_FILE"))
-        for target in targets:
-            if ((target["vehicle_name"] == info["campaign_name"]) or (target["ads_target"] == info["campaign_name"]) or
-                    (target["analyst_target"] == info["campaign_name"])):
-                table_name = target["vehicle_name"].replace("-", "_")
-                break
-        else:
+        target = reference_data.find_target(info["campaign_name"])
+        if target is None:
             logger.warning(f'Название компании для {info["campaign_name"]} не найдено!')
             return None
+        table_name = target["vehicle_name"].replace("-", "_")
+
+        # Уже разрешённые аккаунты не требуют обращений к каталогу и companies до изменения target_names.json
+        schema_cache.check_targets(reference_data.targets_version)
+        key = (info["campaign_name"], info["campaign_id"])
+        if key in schema_cache.resolved:
+            return schema_cache.resolved[key]
+
+        # Параллельные загрузки не должны одновременно создавать одни и те же таблицы
+        async with schema_cache.lock:
+            if key in schema_cache.resolved:
+                return schema_cache.resolved[key]
+
+            if not await self.has_table(conn, "companies"):
+                companies_table = """CREATE TABLE IF NOT EXISTS companies (
+                    id                 BIGSERIAL PRIMARY KEY,
+                    company_name       TEXT NOT NULL UNIQUE,
+                    google_ads_id      TEXT,
+                    ga4_property_id    TEXT,
+                    created_at         TIMESTAMPTZ NOT NULL DEFAULT now()
+                );"""
+                await conn.execute(companies_table)
+                schema_cache.add_table("companies")
+
+            await self.ensure_daily_metrics(conn)
+            await self.ensure_kpi_summary(conn)
+
+            # table_name - ключ авто (company_name в companies), данные всех авто лежат в daily_metrics
+            db_id = await self.insert_company(conn, table_name, info['campaign_id'])
+
+            schema_cache.resolved[key] = (db_id, table_name)
+            return db_id, table_name
+
+    async def ensure_daily_metrics(self, conn: asyncpg.Connection) -> None:
+        """
+        Общая таблица фактов по всем авто, секционированная по месяцам.
+        Секции создаёт ensure_partitions перед записью.
+        """
+        if await self.has_table(conn, "daily_metrics"):
+            return
 
-        if not await self.table_exists(conn, "companies"):
-            companies_table = """CREATE TABLE IF NOT EXISTS companies (
-                id                 BIGSERIAL PRIMARY KEY,
-                company_name       TEXT NOT NULL UNIQUE,
-                google_ads_id      TEXT,
-                ga4_property_id    TEXT,
-                created_at         TIMESTAMPTZ NOT NULL DEFAULT now()
-            );"""
-            await conn.execute(companies_table)
-
-        db_id = await self.insert_company(conn, table_name, info['campaign_id'])
-        current_table = f"""CREATE TABLE IF NOT EXISTS {table_name} (
+        columns = ",\n            ".join(f"{name:<24} {sql_type} DEFAULT 0" for name, sql_type in self.METRIC_COLUMNS.items())
+        await conn.execute(f"""CREATE TABLE IF NOT EXISTS daily_metrics (
             vehicle_id   BIGINT NOT NULL REFERENCES companies(id),
             date         DATE NOT NULL,
-            clicks                   INTEGER DEFAULT 0,
-            impressions              INTEGER DEFAULT 0,
-            duration                 DOUBLE PRECISION DEFAULT 0,
-            page_view                INTEGER DEFAULT 0,
-            session_start            INTEGER DEFAULT 0,
-            user_engagement          INTEGER DEFAULT 0,
-            first_visit              INTEGER DEFAULT 0,
-            view_item                INTEGER DEFAULT 0,
-            click                    INTEGER DEFAULT 0,
-            get_call                 INTEGER DEFAULT 0,
-            scroll                   INTEGER DEFAULT 0,
-            form_start               INTEGER DEFAULT 0,
-            g_msgh2bb72v             INTEGER DEFAULT 0,
-            g_3wlwzyjn52             INTEGER DEFAULT 0,
-            g_ekmr3t60q4             INTEGER DEFAULT 0,
-            all_forms                INTEGER DEFAULT 0,
-            binotel_ct_call_details  INTEGER DEFAULT 0,
-            binotel_ct_call_received INTEGER DEFAULT 0,
-            total_users              INTEGER DEFAULT 0,
-            
-            ctr                      DOUBLE PRECISION DEFAULT 0,
-            cost_micros              DOUBLE PRECISION DEFAULT 0,
-            average_cpc              DOUBLE PRECISION DEFAULT 0,
-        
+            {columns},
+
             created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
-        
+
             PRIMARY KEY (vehicle_id, date)
-        );
+        ) PARTITION BY RANGE (date);""")
+        await conn.execute("CREATE INDEX IF NOT EXISTS daily_metrics_date_idx ON daily_metrics (date);")
+        schema_cache.add_table("daily_metrics")
+
+    async def ensure_partitions(self, conn: asyncpg.Connection, months: List[date]) -> None:
         """
-        table_exist = await self.table_exists(conn, table_name)
-#
-        if not table_exist:
-            await conn.execute(current_table)
+        Создаёт месячные секции daily_metrics. Вызывается вне транзакции записи:
+        секцию могли уже создать параллельно, и ошибка не должна откатывать данные.
+        """
+        async with schema_cache.lock:
+            for month in sorted({m.replace(day=1) for m in months}):
+                partition = f"daily_metrics_y{month.year}m{month.month:02d}"
+                if await self.has_table(conn, partition):
+                    continue
+                next_month = (month + timedelta(days=32)).replace(day=1)
+                try:
+                    await conn.execute(
+                        f"""CREATE TABLE IF NOT EXISTS {partition} PARTITION OF daily_metrics
+                        FOR VALUES FROM ('{month.isoformat()}') TO ('{next_month.isoformat()}');"""
+                    )
+                except (asyncpg.exceptions.DuplicateTableError, asyncpg.exceptions.UniqueViolationError):
+                    pass
+                schema_cache.add_table(partition)
 
-        return db_id, table_name
+    async def ensure_kpi_summary(self, conn: asyncpg.Connection) -> None:
+        """
+        Сводная таблица KPI по авто за месяц для верхней панели брендов.
+        При первом создании заполняется из уже загруженных данных daily_metrics.
+        """
+        if await self.has_table(conn, "vehicle_kpi_summary"):
+            return
+
+        await conn.execute("""CREATE TABLE IF NOT EXISTS vehicle_kpi_summary (
+            vehicle      TEXT NOT NULL,
+            month        DATE NOT NULL,
+            ctr          DOUBLE PRECISION DEFAULT 0,
+            cost         DOUBLE PRECISION DEFAULT 0,
+            cpc          DOUBLE PRECISION DEFAULT 0,
+            clicks       BIGINT DEFAULT 0,
+            impressions  BIGINT DEFAULT 0,
+            last_date    DATE,
+            last_ctr     DOUBLE PRECISION DEFAULT 0,
+            last_cost    DOUBLE PRECISION DEFAULT 0,
+            last_cpc     DOUBLE PRECISION DEFAULT 0,
+            updated_at   TIMESTAMPTZ NOT NULL DEFAULT now(),
+
+            PRIMARY KEY (month, vehicle)
+        );""")
+        schema_cache.add_table("vehicle_kpi_summary")
+
+        await self.refresh_kpi_summary(conn, None)
+
+    async def refresh_kpi_summary(self, conn: asyncpg.Connection, table_name: Optional[str],
+                                  months: Optional[List[date]] = None) -> None:
+        """
+        Пересчитывает сводку KPI для авто (None - для всех) по затронутым месяцам (None - по всем).
+        """
+        if months:
+            period_start = min(months)
+            period_end = (max(months) + timedelta(days=32)).replace(day=1)
+        else:
+            period_start = period_end = None
+
+        query = """
+            INSERT INTO vehicle_kpi_summary (vehicle, month, ctr, cost, cpc, clicks, impressions,
+                                             last_date, last_ctr, last_cost, last_cpc, updated_at)
+            SELECT c.company_name,
+                   date_trunc('month', m.date)::date,
+                   AVG(m.ctr),
+                   SUM(m.cost_micros),
+                   AVG(m.average_cpc),
+                   SUM(m.clicks),
+                   SUM(m.impressions),
+                   MAX(m.date),
+                   (array_agg(m.ctr ORDER BY m.date DESC))[1],
+                   (array_agg(m.cost_micros ORDER BY m.date DESC))[1],
+                   (array_agg(m.average_cpc ORDER BY m.date DESC))[1],
+                   now()
+            FROM daily_metrics m
+            JOIN companies c ON c.id = m.vehicle_id
+            WHERE ($1::text IS NULL OR c.company_name = $1)
+              AND ($2::date IS NULL OR m.date >= $2)
+              AND ($3::date IS NULL OR m.date < $3)
+              AND ($4::date[] IS NULL OR date_trunc('month', m.date)::date = ANY($4::date[]))
+            GROUP BY c.company_name, date_trunc('month', m.date)
+            ON CONFLICT (month, vehicle) DO
+            UPDATE SET
+                ctr = EXCLUDED.ctr,
+                cost = EXCLUDED.cost,
+                cpc = EXCLUDED.cpc,
+                clicks = EXCLUDED.clicks,
+                impressions = EXCLUDED.impressions,
+                last_date = EXCLUDED.last_date,
+                last_ctr = EXCLUDED.last_ctr,
+                last_cost = EXCLUDED.last_cost,
+                last_cpc = EXCLUDED.last_cpc,
+                updated_at = EXCLUDED.updated_at;
+            """
+        await conn.execute(query, table_name, period_start, period_end, months)
+
+    async def migrate_vehicle_table(self, conn: asyncpg.Connection, table_name: str) -> int:
+        """
+        Переносит старую отдельную таблицу авто в daily_metrics (повторный запуск безопасен).
+        Возвращает количество перенесённых строк.
+        """
+        columns = ", ".join(self.METRIC_COLUMNS)
+        update_set = ",\n                ".join(f"{c} = EXCLUDED.{c}" for c in self.METRIC_COLUMNS)
+        status = await conn.execute(
+            f"""
+            INSERT INTO daily_metrics (vehicle_id, date, {columns}, created_at)
+            SELECT vehicle_id, date, {columns}, created_at
+            FROM {table_name}
+            ON CONFLICT (vehicle_id, date) DO
+            UPDATE SET
+                {update_set};
+            """
+        )
+        return int(status.split()[-1])
+
+    async def ensure_watermarks(self, conn: asyncpg.Connection) -> None:
+        """
+        Отметки последней полностью загруженной даты по (авто, источник, аккаунт): у авто может быть
+        несколько аккаунтов, и ошибка одного из них не должна сдвигать отметку остальных.
+        """
+        await conn.execute("""CREATE TABLE IF NOT EXISTS ingest_watermarks (
+            vehicle             TEXT NOT NULL,
+            source              TEXT NOT NULL,
+            account_id          TEXT NOT NULL DEFAULT '',
+            last_complete_date  DATE NOT NULL,
+            updated_at          TIMESTAMPTZ NOT NULL DEFAULT now(),
+
+            PRIMARY KEY (vehicle, source, account_id)
+        );""")
+
+        # Таблица из версии с отметками по авто: старая отметка остаётся строкой с пустым account_id
+        await conn.execute("ALTER TABLE ingest_watermarks ADD COLUMN IF NOT EXISTS account_id TEXT NOT NULL DEFAULT '';")
+        key_columns = await conn.fetchval(
+            """
+            SELECT COUNT(*)
+            FROM information_schema.key_column_usage
+            WHERE table_name = 'ingest_watermarks' AND constraint_name = 'ingest_watermarks_pkey';
+            """
+        )
+        if key_columns == 2:
+            await conn.execute("""ALTER TABLE ingest_watermarks DROP CONSTRAINT ingest_watermarks_pkey,
+                                  ADD PRIMARY KEY (vehicle, source, account_id);""")
+
+        # Успешно загруженные диапазоны по источнику и аккаунту. По ним ищутся пропуски: API не отдают
+        # дни без активности, поэтому отсутствие строки в daily_metrics ещё не значит, что день не загружен
+        await conn.execute("""CREATE TABLE IF NOT EXISTS ingest_fetches (
+            vehicle     TEXT NOT NULL,
+            source      TEXT NOT NULL,
+            account_id  TEXT NOT NULL,
+            date_from   DATE NOT NULL,
+            date_to     DATE NOT NULL,
+            fetched_at  TIMESTAMPTZ NOT NULL DEFAULT now()
+        );""")
+        await conn.execute("""CREATE INDEX IF NOT EXISTS ingest_fetches_account_idx
+                              ON ingest_fetches (vehicle, source, account_id, date_to);""")
+
+    async def get_fetch_range(self, conn: asyncpg.Connection, table_name: str, source: str, account_id: str,
+                              today: date) -> Tuple[date, date]:
+        """
+        Диапазон загрузки для аккаунта авто и источника ("ads" / "ga4"): от последней полностью загруженной
+        даты аккаунта (с перезапросом INGEST_RESETTLE_DAYS последних дней) до сегодня. Если за последние
+        INGEST_GAP_LOOKBACK_DAYS есть даты, которые этот источник аккаунта не загрузил (нет в ingest_fetches),
+        диапазон начинается с первой из них.
+        """
+        resettle_days = int(os.getenv("INGEST_RESETTLE_DAYS", "1"))
+        initial_days = int(os.getenv("INGEST_INITIAL_DAYS", "2"))
+        gap_lookback_days = int(os.getenv("INGEST_GAP_LOOKBACK_DAYS", "31"))
+        max_days = int(os.getenv("INGEST_MAX_DAYS", "90"))
+
+        # Пока у аккаунта нет своей отметки, используется старая отметка авто (account_id = '')
+        watermark = await conn.fetchval(
+            """
+            SELECT last_complete_date
+            FROM ingest_watermarks
+            WHERE vehicle = $1 AND source = $2 AND account_id IN ($3, '')
+            ORDER BY account_id = ''
+            LIMIT 1;
+            """,
+            table_name,
+            source,
+            account_id,
+        )
+        if watermark is None:
+            start = today - timedelta(days=initial_days - 1)
+        else:
+            start = min(watermark + timedelta(days=1 - resettle_days), today)
+
+        lookback_start = today - timedelta(days=gap_lookback_days)
+        account = (table_name, source, account_id)
+        await conn.execute(
+            """
+            DELETE FROM ingest_fetches
+            WHERE vehicle = $1 AND source = $2 AND account_id = $3 AND date_to < $4;
+            """,
+            *account,
+            lookback_start,
+        )
+        # Пропуски ищутся только после первой записанной загрузки аккаунта
+        first_gap = await conn.fetchval(
+            """
+            WITH fetches AS (SELECT date_from, date_to FROM ingest_fetches
+                             WHERE vehicle = $1 AND source = $2 AND account_id = $3)
+            SELECT MIN(d)::date
+            FROM generate_series(
+                GREATEST($4::date, COALESCE((SELECT MIN(date_from) FROM fetches), $5::date + 1)),
+                $5::date,
+                interval '1 day'
+            ) AS d
+            WHERE NOT EXISTS (SELECT 1 FROM fetches WHERE d::date BETWEEN date_from AND date_to);
+            """,
+            *account,
+            lookback_start,
+            start - timedelta(days=1),
+        )
+        if first_gap is not None:
+            logger.warning(f'Источник {source} аккаунта {account_id} ("{table_name}") не загрузил данные '
+                           f'начиная с {first_gap}, догружаем')
+            start = min(start, first_gap)
+
+        start = max(start, today - timedelta(days=max_days - 1))
+        return start, today
+
+    async def set_watermark(self, conn: asyncpg.Connection, table_name: str, source: str, account_id: str,
+                            fetched: Tuple[date, date]) -> None:
+        """
+        fetched - (первая дата запроса, последняя полностью загруженная дата) успешной загрузки аккаунта.
+        """
+        date_from, day = fetched
+        await conn.execute(
+            """
+            INSERT INTO ingest_watermarks (vehicle, source, account_id, last_complete_date)
+            VALUES ($1, $2, $3, $4)
+            ON CONFLICT (vehicle, source, account_id) DO
+            UPDATE SET
+                last_complete_date = GREATEST(ingest_watermarks.last_complete_date, EXCLUDED.last_complete_date),
+                updated_at = now();
+            """,
+            table_name,
+            source,
+            account_id,
+            day,
+        )
+        if date_from <= day:
+            await conn.execute(
+                """
+                INSERT INTO ingest_fetches (vehicle, source, account_id, date_from, date_to)
+                VALUES ($1, $2, $3, $4, $5);
+                """,
+                table_name,
+                source,
+                account_id,
+                date_from,
+                day,
+            )
+
+    async def ensure_backfill_checkpoints(self, conn: asyncpg.Connection) -> None:
+        await conn.execute("""CREATE TABLE IF NOT EXISTS backfill_checkpoints (
+            job          TEXT NOT NULL,
+            source       TEXT NOT NULL,
+            account_id   TEXT NOT NULL,
+            chunk_start  DATE NOT NULL,
+            chunk_end    DATE NOT NULL,
+            vehicle      TEXT NOT NULL,
+            rows_written INTEGER DEFAULT 0,
+            done_at      TIMESTAMPTZ NOT NULL DEFAULT now(),
+
+            PRIMARY KEY (job, source, account_id, chunk_start)
+        );""")
+
+    async def get_done_chunks(self, conn: asyncpg.Connection, job: str) -> set:
+        rows = await conn.fetch(
+            """
+            SELECT source, account_id, chunk_start
+            FROM backfill_checkpoints
+            WHERE job = $1;
+            """,
+            job,
+        )
+        return {(row["source"], row["account_id"], row["chunk_start"]) for row in rows}
+
+    async def mark_chunk_done(self, conn: asyncpg.Connection, job: str, source: str, account_id: str,
+                              chunk: Tuple[date, date], vehicle: str, rows_written: int) -> None:
+        await conn.execute(
+            """
+            INSERT INTO backfill_checkpoints (job, source, account_id, chunk_start, chunk_end, vehicle, rows_written)
+            VALUES ($1, $2, $3, $4, $5, $6, $7)
+            ON CONFLICT (job, source, account_id, chunk_start) DO
+            UPDATE SET
+                chunk_end = EXCLUDED.chunk_end,
+                rows_written = EXCLUDED.rows_written,
+                done_at = now();
+            """,
+            job, source, account_id, chunk[0], chunk[1], vehicle, rows_written,
+        )
+
+    async def ensure_data_generation(self, conn: asyncpg.Connection) -> None:
+        """
+        Общее для всех процессов поколение данных: по нему воркеры и реплики сбрасывают кэш страниц.
+        epoch отличает ETag, если таблицу создали заново и поколения начались с нуля.
+        """
+        try:
+            await conn.execute("""CREATE TABLE IF NOT EXISTS data_generation (
+                id          SMALLINT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+                epoch       TEXT NOT NULL DEFAULT substr(md5(random()::text), 1, 8),
+                generation  BIGINT NOT NULL DEFAULT 0
+            );""")
+        except (asyncpg.exceptions.DuplicateTableError, asyncpg.exceptions.UniqueViolationError):
+            pass
+        await conn.execute("INSERT INTO data_generation (id) VALUES (1) ON CONFLICT (id) DO NOTHING;")
+
+    async def get_generation(self, conn: asyncpg.Connection) -> Tuple[str, int]:
+        row = await conn.fetchrow("SELECT epoch, generation FROM data_generation WHERE id = 1;")
+        return row["epoch"], row["generation"]
+
+    async def next_generation(self, conn: asyncpg.Connection) -> Tuple[str, int]:
+        """
+        Увеличивает поколение данных и оповещает все процессы через NOTIFY GENERATION_CHANNEL.
+        """
+        await self.ensure_data_generation(conn)
+        row = await conn.fetchrow(
+            "UPDATE data_generation SET generation = generation + 1 WHERE id = 1 RETURNING epoch, generation;"
+        )
+        await conn.execute("SELECT pg_notify($1, $2);", self.GENERATION_CHANNEL, str(row["generation"]))
+        return row["epoch"], row["generation"]
+
+    # Задача обновления считается выполняемой, пока её соединение держит блокировку обновления;
+    # задачи упавших процессов показываются как failed
+    REFRESH_JOB_SELECT = """
+        SELECT job_id, trigger,
+               CASE WHEN status = 'running' AND NOT EXISTS (
+                   SELECT 1 FROM pg_locks
+                   WHERE locktype = 'advisory' AND objid = $1 AND pid = refresh_jobs.backend_pid AND granted
+               ) THEN 'failed' ELSE status END AS status,
+               error, started_at, finished_at, current_stage, stages::text AS stages, joined
+        FROM refresh_jobs
+    """
+
+    async def ensure_refresh_jobs(self, conn: asyncpg.Connection) -> None:
+        """
+        Запуски обновления данных, общие для всех воркеров и реплик: /refresh в любом процессе
+        видит и присоединяется к обновлению, которое выполняет другой.
+        """
+        try:
+            await conn.execute("""CREATE TABLE IF NOT EXISTS refresh_jobs (
+                job_id         TEXT PRIMARY KEY,
+                trigger        TEXT NOT NULL,
+                status         TEXT NOT NULL DEFAULT 'running',
+                error          TEXT,
+                backend_pid    INTEGER NOT NULL,
+                started_at     TIMESTAMPTZ NOT NULL DEFAULT now(),
+                finished_at    TIMESTAMPTZ,
+                current_stage  TEXT,
+                stages         JSON NOT NULL DEFAULT '{}',
+                joined         INTEGER NOT NULL DEFAULT 0
+            );""")
+        except (asyncpg.exceptions.DuplicateTableError, asyncpg.exceptions.UniqueViolationError):
+            pass
+
+    async def start_refresh_job(self, conn: asyncpg.Connection, lock_id: int, job_id: str, trigger: str,
+                                history: int) -> asyncpg.Record:
+        """
+        Запись нового запуска; conn - соединение, которое уже держит блокировку обновления lock_id.
+        Незавершённые записи прежних запусков закрываются, хранятся последние history запусков.
+        """
+        async with conn.transaction():
+            await conn.execute(
+                """
+                UPDATE refresh_jobs
+                SET status = 'failed', error = 'Процесс обновления завершился до окончания', finished_at = now()
+                WHERE status = 'running';
+                """
+            )
+            await conn.execute(
+                "INSERT INTO refresh_jobs (job_id, trigger, backend_pid) VALUES ($1, $2, pg_backend_pid());",
+                job_id,
+                trigger,
+            )
+            await conn.execute(
+                """
+                DELETE FROM refresh_jobs
+                WHERE job_id NOT IN (SELECT job_id FROM refresh_jobs ORDER BY started_at DESC LIMIT $1);
+                """,
+                history,
+            )
+        return await conn.fetchrow(f"{self.REFRESH_JOB_SELECT} WHERE job_id = $2;", lock_id, job_id)
+
+    async def update_refresh_job(self, conn: asyncpg.Connection, job_id: str, status: str, error: Optional[str],
+                                 current_stage: Optional[str], stages: Dict[str, Optional[float]]) -> None:
+        await conn.execute(
+            """
+            UPDATE refresh_jobs
+            SET status = $2, error = $3, current_stage = $4, stages = $5::json,
+                finished_at = CASE WHEN $2 = 'running' THEN NULL ELSE now() END
+            WHERE job_id = $1;
+            """,
+            job_id,
+            status,
+            error,
+            current_stage,
+            json.dumps(stages),
+        )
+
+    async def join_refresh_job(self, conn: asyncpg.Connection, lock_id: int) -> Optional[asyncpg.Record]:
+        """
+        Присоединение к выполняемому запуску: увеличивает joined и возвращает его запись (None - запуска нет).
+        """
+        job_id = await conn.fetchval(
+            f"""
+            WITH jobs AS ({self.REFRESH_JOB_SELECT})
+            UPDATE refresh_jobs SET joined = joined + 1
+            WHERE job_id = (SELECT job_id FROM jobs WHERE status = 'running' ORDER BY started_at DESC LIMIT 1)
+            RETURNING job_id;
+            """,
+            lock_id,
+        )
+        if job_id is None:
+            return None
+        return await self.get_refresh_job(conn, lock_id, job_id)
+
+    async def get_refresh_job(self, conn: asyncpg.Connection, lock_id: int,
+                              job_id: Optional[str] = None) -> Optional[asyncpg.Record]:
+        # Без job_id - последний запуск
+        if job_id is None:
+            return await conn.fetchrow(f"{self.REFRESH_JOB_SELECT} ORDER BY started_at DESC LIMIT 1;", lock_id)
+        return await conn.fetchrow(f"{self.REFRESH_JOB_SELECT} WHERE job_id = $2;", lock_id, job_id)
 
     async def insert_company(self, conn: asyncpg.Connection, company_name: str, company_id: str) -> int:
         # 1) Проверяем, есть ли такая компания, и какие там значения
@@ -324,69 +915,125 @@ class SQL:
             return db_id
 
         # 5) Если company_name не существует — создаём и пишем company_id в google_ads_id
+        #    (компанию могла уже создать параллельная загрузка - тогда просто берём её id)
         new_id = await conn.fetchval(
             """
             INSERT INTO companies (company_name, google_ads_id)
-            VALUES ($1, $2) RETURNING id;
+            VALUES ($1, $2)
+            ON CONFLICT (company_name) DO UPDATE SET company_name = EXCLUDED.company_name
+            RETURNING id;
             """,
             company_name,
             company_id,
         )
         return int(new_id)
 
-    async def table_exists(self, conn: asyncpg.Connection, table_name: str, schema: str = "public") -> bool:
+    async def load_catalog(self, conn: asyncpg.Connection, schema: str = "public") -> None:
+        if schema_cache.tables is not None and not schema_cache.stale:
+            return
+        rows = await conn.fetch(
+            """
+            SELECT table_name
+            FROM information_schema.tables
+            WHERE table_schema = $1;
+            """,
+            schema,
+        )
+        # Новый набор заменяет старый целиком: ensure_* в других задачах дописывают в него без ошибок
+        schema_cache.tables = {row["table_name"] for row in rows}
+        schema_cache.stale = False
+
+    async def has_table(self, conn: asyncpg.Connection, table_name: str) -> bool:
+        """
+        Проверка по каталогу таблиц, прочитанному один раз за время жизни процесса.
+        """
+        await self.load_catalog(conn)
+        return table_name in schema_cache.tables
+
+    async def set_data(self, conn: asyncpg.Connection, table_name: str, db_id: int,
+                       rows: Dict[str, Dict], refresh_summary: bool = True) -> None:
+        """
+        Пишет собранные за обновление строки авто: по одному upsert на (vehicle_id, date).
+        rows - {дата ISO: {колонка: значение}} из всех источников сразу.
         """
-        Проверка существования таблицы через information_schema.
+        # Upsert обновляет только переданные колонки, поэтому даты группируются по набору колонок
+        rows_by_columns = {}
+        for curr_date, values in rows.items():
+            rows_by_columns.setdefault(tuple(sorted(values)), []).append({"date": curr_date, **values})
+
+        for columns, column_rows in rows_by_columns.items():
+            await self.upsert_rows(conn, db_id, list(columns), column_rows)
+        logger.info(f'Данные для "{table_name}" записаны: {len(rows)} дн., {len(rows_by_columns)} запрос(ов)')
+
+        # Сводка KPI за месяц пересчитывается только по месяцам, которые затронула загрузка
+        months = sorted({date.fromisoformat(d).replace(day=1) for d in rows})
+        if months and refresh_summary:
+            await self.refresh_kpi_summary(conn, table_name, months)
+
+    async def upsert_rows(self, conn: asyncpg.Connection, db_id: int, columns: List[str],
+                          rows: List[Dict]) -> None:
         """
-        q = """
-            SELECT EXISTS (SELECT 1 \
-                           FROM information_schema.tables \
-                           WHERE table_schema = $1 \
-                             AND table_name = $2); \
+        Пакетный upsert одним запросом: значения передаются массивами и разворачиваются через UNNEST.
+        """
+        # Одна дата может встретиться только один раз в ON CONFLICT DO UPDATE - оставляем последнюю
+        by_date = {row["date"]: row for row in rows}
+        if not by_date:
+            return
+
+        dates = [date.fromisoformat(d) for d in by_date]
+        values = [[row[c] for row in by_date.values()] for c in columns]
+
+        await conn.execute(self.upsert_query(columns), db_id, dates, *values)
+
+    def upsert_query(self, columns: List[str]) -> str:
+        key = tuple(columns)
+        query = self.upsert_queries.get(key)
+        if query is not None:
+            return query
+
+        arrays = ", ".join(
+            f"${i}::{self.METRIC_COLUMNS.get(c, 'INTEGER')}[]" for i, c in enumerate(columns, start=3)
+        )
+        update_set = ",\n                ".join(f'"{c}" = EXCLUDED."{c}"' for c in columns)
+        query = f"""
+            INSERT INTO daily_metrics (vehicle_id, date, {", ".join(f'"{c}"' for c in columns)})
+            SELECT $1::bigint, * FROM UNNEST($2::date[], {arrays})
+            ON CONFLICT (vehicle_id, date) DO
+            UPDATE SET
+                {update_set};
             """
-        return await conn.fetchval(q, schema, table_name)
+        self.upsert_queries[key] = query
+        return query
+
+class Functions:
+    def __init__(self):
+        # Шаблон GAQL с метками day_2 (начало) и day_1 (конец), диапазон подставляет build_traffic_query
+        self.traffic_drop_template = os.getenv("TRAFFIC_DROP_QUERY")
 
-    async def set_data(self, conn: asyncpg.Connection, info: dict, table_name:str, data_type:str, db_id: int) -> None:
+    def build_traffic_query(self, start: date, end: date) -> str:
+        return self.traffic_drop_template.replace("day_1", end.isoformat()).replace("day_2", start.isoformat())
+
+    async def get_traffic(self, traffic_drop_per_day: list) -> list:
+        clicks_by_date = [{"date": row.segments.date, "clicks": row.metrics.clicks, "impressions": row.metrics.impressions,
+                           "ctr": round(row.metrics.ctr * 100, 1), "cost_micros": round(row.metrics.cost_micros / 1_000_000, 2),
+                           "average_cpc": round(row.metrics.average_cpc / 1_000_000, 2)} for row in traffic_drop_per_day]
+
+        return clicks_by_date
+
+    @staticmethod
+    def to_columns(data_type: str, data: list) -> Dict[str, Dict]:
+        """
+        Приводит данные одного источника к виду {дата ISO: {колонка таблицы авто: значение}}.
+        """
         match data_type:
             case "clicks_per_day":
-                for i in info['data']:
-                    curr_date = date.fromisoformat(i["date"])
-                    clicks = i["clicks"]
-                    impressions = i["impressions"]
-                    ctr = i["ctr"]
-                    cost_micros = i["cost_micros"]
-                    average_cpc = i["average_cpc"]
-                    query = f"""
-                              INSERT INTO {table_name} (vehicle_id, date, clicks, impressions, ctr, cost_micros, average_cpc)
-                              VALUES ($1, $2, $3, $4, $5, $6, $7)
-                              ON CONFLICT (vehicle_id, date) DO
-                              UPDATE SET
-                                  clicks = EXCLUDED.clicks,
-                                  impressions = EXCLUDED.impressions,
-                                  ctr = EXCLUDED.ctr,
-                                  cost_micros = EXCLUDED.cost_micros,
-                                  average_cpc = EXCLUDED.average_cpc;   
-                              """
-                    await conn.execute(query, db_id, curr_date, clicks, impressions, ctr, cost_micros, average_cpc)
-                else:
-                    logger.info(f'Очередь запросов "clicks_per_day" для "{table_name}" cоставлена!')
+                return {i["date"]: {"clicks": i["clicks"], "impressions": i["impressions"], "ctr": i["ctr"],
+                                    "cost_micros": i["cost_micros"], "average_cpc": i["average_cpc"]} for i in data}
             case "duration":
-                for i in info['data']:
-                    curr_date = date.fromisoformat(i["date"])
-                    duration = i["duration"]
-                    query = f"""
-                        INSERT INTO {table_name} (vehicle_id, date, duration)
-                        VALUES ($1, $2, $3)
-                        ON CONFLICT (vehicle_id, date) DO
-                        UPDATE SET
-                            duration = EXCLUDED.duration;
-                        """
-                    await conn.execute(query, db_id, curr_date, duration)
-                else:
-                    logger.info(f'Очередь запросов "duration" для "{table_name}" cоставлена!')
+                return {i["date"]: {"duration": i["duration"]} for i in data}
             case "events":
                 counts_by_date = {}
-                for row in info["data"]:
+                for row in data:
                     d = row["date"]
                     e = row["eventName"]
                     if e not in ('page_view', 'session_start', 'user_engagement', 'first_visit', 'view_item',
@@ -403,64 +1050,12 @@ class SQL:
                                 e = 'g_ekmr3t60q4'
                     c = row["eventCount"]
                     counts_by_date.setdefault(d, {})[e] = c
-
-                for curr_date, events_map in counts_by_date.items():
-                    curr_date = date.fromisoformat(curr_date)
-                    curr_events = list(events_map.keys())
-                    columns = ["vehicle_id", "date"] + curr_events
-                    placeholders = [f"${i}" for i in range(1, len(columns) + 1)]
-                    values = [db_id, curr_date] + [
-                        events_map[e] for e in curr_events
-                    ]
-                    update_set = ",\n        ".join(
-                        [f'"{e}" = EXCLUDED."{e}"' for e in curr_events]
-                    )
-                    query = f"""
-                    INSERT INTO {table_name} (
-                        {", ".join([f'"{c}"' if c not in ("vehicle_id", "date") else c for c in columns])}
-                    )
-                    VALUES ({", ".join(placeholders)})
-                    ON CONFLICT (vehicle_id, date) DO
-                    UPDATE SET
-                        {update_set};
-                    """
-                    await conn.execute(query, *values)
-                else:
-                    logger.info(f'Очередь запросов "events" для "{table_name}" cоставлена!')
+                return counts_by_date
             case "traffic":
-                for i in info['data']:
-                    curr_date = date.fromisoformat(i["date"])
-                    total_users = i["total_users"]
-                    query = f"""
-                            INSERT INTO {table_name} (vehicle_id, date, total_users)
-                            VALUES ($1, $2, $3)
-                            ON CONFLICT (vehicle_id, date) DO
-                            UPDATE SET
-                                total_users = EXCLUDED.total_users;
-                            """
-                    await conn.execute(query, db_id, curr_date, total_users)
-                else:
-                    logger.info(f'Очередь запросов "traffic" для "{table_name}" cоставлена!')
+                return {i["date"]: {"total_users": i["total_users"]} for i in data}
             case _:
                 logger.warning(f"Неожиданное вхождение данных: {data_type}")
-                return
-
-class Functions:
-    def __init__(self):
-        self.traffic_drop = os.getenv("TRAFFIC_DROP_QUERY")
-        self.yesterday = (date.today() - timedelta(days=0)).isoformat()
-        self.month_before = (date.today() - timedelta(days=1)).isoformat()
-
-    async def put_current_days(self) -> None:
-        self.traffic_drop = self.traffic_drop.replace("day_1", self.yesterday).replace("day_2", self.month_before)
-        return
-
-    async def get_traffic(self, traffic_drop_per_day: list) -> list:
-        clicks_by_date = [{"date": row.segments.date, "clicks": row.metrics.clicks, "impressions": row.metrics.impressions,
-                           "ctr": round(row.metrics.ctr * 100, 1), "cost_micros": round(row.metrics.cost_micros / 1_000_000, 2),
-                           "average_cpc": round(row.metrics.average_cpc / 1_000_000, 2)} for row in traffic_drop_per_day]
-
-        return clicks_by_date
+                return {}
 
 class Other:
     @staticmethod
@@ -470,68 +1065,236 @@ class Other:
             return json.loads(content)
 
     @staticmethod
-    async def save_data(data: list, data_type: str, sql: SQL = SQL()) -> None:
+    async def save_data(batches: List[Tuple[str, list]], sql: SQL = SQL()) -> Dict[str, str]:
+        """
+        batches - [(тип данных, данные аккаунтов), ...]. Данные всех источников сначала
+        сводятся в одну запись на (таблица авто, дата), затем каждая строка пишется один раз.
+        Каждое авто пишется в своей короткой транзакции, авто пишутся параллельно в пределах пула.
+        Возвращает {таблица: ошибка} для авто, которые записать не удалось.
+        """
         await sql.create_conn()
+
+        records = {}
+        watermarks = {}
         async with sql.pool.acquire() as conn:
-            # Вся логика в транзакции, чтобы было атомарно
-            async with conn.transaction():
+            for data_type, data in batches:
                 for info in data:
                     service_data = await sql.ensure_schema(conn, info)
-                    if service_data is not None:
-                        db_id, table_name = service_data
-                        await sql.set_data(conn=conn, info=info, data_type=data_type, table_name=table_name, db_id=db_id)
+                    if service_data is None:
+                        continue
+                    db_id, table_name = service_data
+                    if info.get("watermark"):
+                        source, date_from, day = info["watermark"]
+                        key = (table_name, source, str(info["campaign_id"]))
+                        if key in watermarks:
+                            date_from, day = min(date_from, watermarks[key][0]), max(day, watermarks[key][1])
+                        watermarks[key] = (date_from, day)
+                    record = records.setdefault(table_name, {"db_id": db_id, "rows": {}})
+                    for curr_date, values in Functions.to_columns(data_type, info['data']).items():
+                        record["rows"].setdefault(curr_date, {}).update(values)
+
+            # Секции за все месяцы загрузки создаются до транзакций записи
+            months = {date.fromisoformat(d).replace(day=1) for record in records.values() for d in record["rows"]}
+            await sql.ensure_partitions(conn, list(months))
+
+        async def write_table(table_name: str, record: dict) -> Optional[str]:
+            try:
+                async with sql.pool.acquire() as conn:
+                    async with conn.transaction():
+                        await sql.set_data(conn=conn, table_name=table_name, db_id=record["db_id"],
+                                           rows=record["rows"])
+
+                        # Отметка о загрузке пишется в той же транзакции, что и сами данные
+                        for (watermark_table, source, account_id), fetched in watermarks.items():
+                            if watermark_table == table_name:
+                                await sql.set_watermark(conn, table_name, source, account_id, fetched)
+            except Exception as e:
+                # Ошибка одного авто откатывает только его данные; схема будет перепроверена при следующей записи
+                logger.error(f'Ошибка записи данных для "{table_name}": {e}')
+                schema_cache.invalidate()
+                return str(e)
+            return None
 
+        results = await asyncio.gather(*(write_table(table_name, record) for table_name, record in records.items()))
+        return {table_name: error for table_name, error in zip(records, results) if error is not None}
+
+    @staticmethod
+    async def save_ads_stream(google: Google, functions: Functions, customer_id: str, campaign_name: str,
+                              query: str, sql: SQL = SQL(), watermark: Optional[Tuple[date, date]] = None) -> int:
+        """
+        Пишет поток Google Ads аккаунта в БД пакетами по мере поступления, не собирая весь ответ в памяти.
+        Каждый пакет - отдельная короткая транзакция; последний пакет пишется в одной транзакции
+        с отметкой о загрузке (watermark - загруженный диапазон, как в SQL.set_watermark).
+        Возвращает количество записанных дней.
+        """
+        await sql.create_conn()
+        info = {"campaign_name": campaign_name, "campaign_id": customer_id}
+        async with sql.pool.acquire() as conn:
+            service_data = await sql.ensure_schema(conn, info)
+            if service_data is None:
+                return 0
+            db_id, table_name = service_data
+
+            months = set()
+
+            async def write_batch(rows: dict, last: bool = False) -> None:
+                if rows:
+                    await sql.ensure_partitions(conn, [date.fromisoformat(d) for d in rows])
+                async with conn.transaction():
+                    if rows:
+                        await sql.set_data(conn=conn, table_name=table_name, db_id=db_id, rows=rows,
+                                           refresh_summary=False)
+                    if last and watermark is not None:
+                        await sql.set_watermark(conn, table_name, "ads", customer_id, watermark)
+                months.update(date.fromisoformat(d).replace(day=1) for d in rows)
+
+            # Пакет пишется, когда пришёл следующий: так последний известен и уходит вместе с отметкой.
+            # aclosing: при ошибке записи поток закрывается сразу, а не при сборке мусора генератора
+            total = 0
+            pending = None
+            async with aclosing(google.gaql_stream(customer_id, query)) as stream:
+                async for batch in stream:
+                    rows = Functions.to_columns("clicks_per_day", await functions.get_traffic(batch))
+                    if pending is not None:
+                        await write_batch(pending)
+                    pending = rows
+                    total += len(rows)
+            await write_batch(pending or {}, last=True)
+
+            if months:
+                await sql.refresh_kpi_summary(conn, table_name, sorted(months))
+        return total
+
+
+async def refresh_data_func(progress=None):
+    """
+    progress - необязательный объект с async методом start_stage(name) для отслеживания этапов (RefreshJob).
+    """
+    async def stage(name: str) -> None:
+        if progress is not None:
+            await progress.start_stage(name)
 
-async def refresh_data_func():
     google = Google()
     sql = SQL()
     functions = Functions()
 
-    await functions.put_current_days()
-
-    sub_ads_accounts = await google.get_sub_accounts()
-
-    # Google Ads
-    traffic_drop_per_day = []
-    for sub in sub_ads_accounts:
-        sub_id = sub.customer_client.client_customer.removeprefix('customers/')
-        sub_name = sub.customer_client.descriptive_name or ""
-        logger.info(f"Подчинённый рекламный аккаунт: {sub_name} ({sub_id})")
-####
-        if sub_id == '5109744025':
-            continue
-####
-        # Google Ads Result
-        ads_results = await asyncio.gather(
-            google.gaql_async(sub_id, functions.traffic_drop)
-        )
-        traffic_drop_per_day_temp = ads_results[0]
-        traffic_drop_per_day_temp = await functions.get_traffic(traffic_drop_per_day_temp)
-        traffic_drop_per_day.append({"campaign_name": sub_name, "campaign_id": sub_id, "data": traffic_drop_per_day_temp})
-    await Other.save_data(traffic_drop_per_day, "clicks_per_day", sql)
-
-    # Google Analyst
-    sub_analytics_account = await Other.get_data(os.getenv("ANALYTIC_ACCOUNTS_FILE"))
-#
-    duration_data = []
-    events_data = []
-    traffic_data = []
-    for sub in sub_analytics_account:
-        logger.info(f"Текущий обрабатываемый аккаунт аналитики: {sub['account_name']} {sub['account_id']}")
-        # Время пребывания на сайте
-        duration_temp = await google.get_analyst_data(sub['account_id'])
-        duration_data.append({"campaign_name": sub['account_name'], "campaign_id": sub['account_id'], "data": duration_temp})
-        # События на сайте
-        events_temp = await google.get_analyst_events(property_id=sub['account_id'])
-        events_data.append({"campaign_name": sub['account_name'], "campaign_id": sub['account_id'], "data": events_temp})
-        # Трафик сайта
-        traffic_temp = await google.get_analyst_traffic(property_id=sub['account_id'])
-        traffic_data.append(
-            {"campaign_name": sub['account_name'], "campaign_id": sub['account_id'], "data": traffic_temp})
-    await Other.save_data(duration_data, "duration", sql)
-    await Other.save_data(events_data, "events", sql)
-    await Other.save_data(traffic_data, "traffic", sql)
-    logger.info("Данные успешно сохранены")
+    # Пул этого запуска закрывается в конце: процесс сервера живёт долго, а запусков много
+    try:
+        await stage("plan")
+        await sql.create_conn()
+        async with sql.pool.acquire() as conn:
+            await sql.ensure_watermarks(conn)
+            # Каталог таблиц читается один раз за время жизни процесса
+            await sql.load_catalog(conn)
+        today = date.today()
+
+        async def plan_range(campaign_name: str, account_id: str, source: str) -> Optional[Tuple[date, date]]:
+            # Диапазон загрузки считается по отметке последней загрузки аккаунта и пропускам в данных его авто
+            target = reference_data.find_target(campaign_name)
+            if target is None:
+                logger.warning(f'Название компании для {campaign_name} не найдено!')
+                return None
+            async with sql.pool.acquire() as conn:
+                return await sql.get_fetch_range(conn, target["vehicle_name"].replace("-", "_"), source,
+                                                 str(account_id), today)
+
+        await stage("ads")
+        sub_ads_accounts = await google.get_sub_accounts()
+
+        # Google Ads
+        # Запросы по аккаунтам идут параллельно, но не больше ADS_CONCURRENCY одновременно
+        ads_sem = asyncio.Semaphore(int(os.getenv("ADS_CONCURRENCY", "5")))
+        ads_stream = os.getenv("ADS_STREAM", "0") == "1"
+
+        async def fetch_ads(sub) -> Optional[dict]:
+            sub_id = sub.customer_client.client_customer.removeprefix('customers/')
+            sub_name = sub.customer_client.descriptive_name or ""
+            logger.info(f"Подчинённый рекламный аккаунт: {sub_name} ({sub_id})")
+    ####
+            if sub_id == google.manager_id:
+                return None
+    ####
+            fetch_range = await plan_range(sub_name, sub_id, "ads")
+            if fetch_range is None:
+                return None
+            start, end = fetch_range
+            query = functions.build_traffic_query(start, end)
+            # Сегодняшний день ещё не завершён - полностью загруженным считается вчерашний
+            complete_until = end - timedelta(days=1)
+
+            async with ads_sem:
+                if ads_stream:
+                    # Потоковый режим: строки аккаунта пишутся в БД сразу, без объединения с GA4
+                    try:
+                        await Other.save_ads_stream(google, functions, sub_id, sub_name, query, sql,
+                                                    watermark=(start, complete_until))
+                    except Exception as e:
+                        logger.error(f"Ошибка потоковой загрузки Google Ads для {sub_name} ({sub_id}): {e}")
+                    return None
+                try:
+                    traffic_drop_per_day_temp = await google.gaql_async(sub_id, query)
+                except Exception as e:
+                    # Ошибка одного аккаунта не должна срывать загрузку остальных
+                    logger.error(f"Ошибка запроса Google Ads для {sub_name} ({sub_id}): {e}")
+                    return None
+            traffic_drop_per_day_temp = await functions.get_traffic(traffic_drop_per_day_temp)
+            return {"campaign_name": sub_name, "campaign_id": sub_id, "data": traffic_drop_per_day_temp,
+                    "watermark": ("ads", start, complete_until)}
+
+        ads_results = await asyncio.gather(*(fetch_ads(sub) for sub in sub_ads_accounts))
+        traffic_drop_per_day = [result for result in ads_results if result is not None]
+
+        # Google Analyst
+        await stage("analytics")
+        sub_analytics_account = reference_data.analytic_accounts
+        analytics_sem = asyncio.Semaphore(google.analytics_concurrency)
+
+        async def fetch_analytics(sub) -> Optional[Tuple[dict, dict, dict]]:
+            fetch_range = await plan_range(sub['account_name'], sub['account_id'], "ga4")
+            if fetch_range is None:
+                return None
+            start, end = fetch_range
+
+            async with analytics_sem:
+                logger.info(f"Текущий обрабатываемый аккаунт аналитики: {sub['account_name']} {sub['account_id']} "
+                            f"({start} - {end})")
+                try:
+                    # Время пребывания на сайте, события и трафик сайта - одним пакетным запросом
+                    duration_temp, events_temp, traffic_temp = await google.get_analyst_batch(
+                        sub['account_id'], start_date=start.isoformat(), end_date=end.isoformat()
+                    )
+                except Exception as e:
+                    logger.error(f"Ошибка запроса Google Analytics для {sub['account_name']} ({sub['account_id']}): {e}")
+                    return None
+            account = {"campaign_name": sub['account_name'], "campaign_id": sub['account_id'],
+                       "watermark": ("ga4", start, end - timedelta(days=1))}
+            return {**account, "data": duration_temp}, {**account, "data": events_temp}, {**account, "data": traffic_temp}
+
+        try:
+            analytics_results = await asyncio.gather(*(fetch_analytics(sub) for sub in sub_analytics_account))
+        finally:
+            google.close()
+        analytics_results = [result for result in analytics_results if result is not None]
+
+        duration_data = [result[0] for result in analytics_results]
+        events_data = [result[1] for result in analytics_results]
+        traffic_data = [result[2] for result in analytics_results]
+
+        await stage("save")
+        failed = await Other.save_data([("clicks_per_day", traffic_drop_per_day), ("duration", duration_data),
+                                        ("events", events_data), ("traffic", traffic_data)], sql)
+        if failed:
+            logger.warning(f"Данные сохранены, кроме: {', '.join(failed)}")
+        else:
+            logger.info("Данные успешно сохранены")
+
+        # Поколение хранится в БД, чтобы кэш сбросили все воркеры и реплики, а не только этот процесс
+        async with sql.pool.acquire() as conn:
+            epoch, generation = await sql.next_generation(conn)
+        dashboard_cache.sync(epoch, generation)
+        logger.info(f"Кэш страниц сброшен, поколение данных: {generation}")
+    finally:
+        await sql.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,89 @@
+import gzip
+import os
+from typing import Dict, Optional
+
+import brotli
+from fastapi import Request, Response
+
+
+class CachedBody:
+    """
+    Готовое тело ответа одного поколения данных: ETag и сжатые варианты (br/gzip),
+    которые считаются один раз при первом запросе с нужной кодировкой.
+    """
+    MIN_COMPRESS_SIZE = 1024
+    BROTLI_QUALITY = int(os.getenv("HTTP_BROTLI_QUALITY", "6"))
+    GZIP_LEVEL = int(os.getenv("HTTP_GZIP_LEVEL", "6"))
+
+    def __init__(self, content: bytes, etag: str):
+        self.content = content
+        self.etag = etag
+        self._encoded: Dict[str, bytes] = {"identity": content}
+
+    def encoded(self, encoding: str) -> bytes:
+        body = self._encoded.get(encoding)
+        if body is None:
+            if encoding == "br":
+                body = brotli.compress(self.content, quality=self.BROTLI_QUALITY)
+            elif encoding == "gzip":
+                body = gzip.compress(self.content, compresslevel=self.GZIP_LEVEL)
+            else:
+                raise ValueError(f"Unsupported encoding: {encoding}")
+            self._encoded[encoding] = body
+        return body
+
+    def precompress(self) -> None:
+        if len(self.content) >= self.MIN_COMPRESS_SIZE:
+            for encoding in ("br", "gzip"):
+                self.encoded(encoding)
+
+    def choose_encoding(self, accept_encoding: Optional[str]) -> str:
+        if not accept_encoding or len(self.content) < self.MIN_COMPRESS_SIZE:
+            return "identity"
+
+        accepted = set()
+        for item in accept_encoding.split(","):
+            name, _, params = item.partition(";")
+            params = params.strip().replace(" ", "")
+            try:
+                q = float(params[2:]) if params.startswith("q=") else 1.0
+            except ValueError:
+                q = 0.0
+            if q > 0:
+                accepted.add(name.strip().lower())
+
+        for encoding in ("br", "gzip"):
+            if encoding in accepted or "*" in accepted:
+                return encoding
+        return "identity"
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    # Слабое сравнение: сжатые варианты одного тела имеют один ETag
+    if not if_none_match:
+        return False
+    own = etag.removeprefix("W/")
+    for value in if_none_match.split(","):
+        value = value.strip()
+        if value == "*" or value.removeprefix("W/") == own:
+            return True
+    return False
+
+
+def conditional_response(request: Request, body: CachedBody, media_type: str) -> Response:
+    """
+    304 без тела, если у браузера уже есть это поколение данных, иначе сжатое тело.
+    """
+    headers = {
+        "ETag": body.etag,
+        "Vary": "Accept-Encoding",
+        # Браузер хранит ответ, но перед каждым показом сверяет ETag
+        "Cache-Control": "no-cache",
+    }
+    if etag_matches(request.headers.get("if-none-match"), body.etag):
+        return Response(status_code=304, headers=headers)
+
+    encoding = body.choose_encoding(request.headers.get("accept-encoding"))
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(content=body.encoded(encoding), media_type=media_type, headers=headers)
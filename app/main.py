@@ -1,4 +1,5 @@
 import asyncio
+import os
 import sys
 from contextlib import asynccontextmanager
 from zoneinfo import ZoneInfo
@@ -6,397 +7,136 @@ from zoneinfo import ZoneInfo
 from apscheduler.triggers.cron import CronTrigger
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
-from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import HTMLResponse, JSONResponse, Response
 from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
 
+from cache import dashboard_cache, ondemand_cache
+from cluster import Cluster
 from get_google_data import refresh_data_func
-from data_transformation import Data
+from data_transformation import SQL
+from http_cache import conditional_response
+from reference_data import reference_data
+from refresh_jobs import RefreshCoordinator
+from snapshots import get_dashboard_body, get_page_body, get_traffic_month_body, prerender
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    reference_data.load()
+    app.state.db_pool = await SQL.create_pool()
+
     loop = asyncio.get_event_loop()
     scheduler = AsyncIOScheduler(event_loop=loop)
     scheduler.add_job(refresh_data, trigger=CronTrigger(hour=9, minute=0, timezone=ZoneInfo("Europe/Kyiv")))
     scheduler.add_job(refresh_data, trigger=CronTrigger(hour=12, minute=0, timezone=ZoneInfo("Europe/Kyiv")))
     scheduler.add_job(refresh_data, trigger=CronTrigger(hour=15, minute=0, timezone=ZoneInfo("Europe/Kyiv")))
-    scheduler.start()
+
+    # Расписание выполняется только в ведущем процессе среди воркеров и реплик
+    cluster = Cluster(scheduler, on_generation=on_generation)
+    await cluster.start()
+
+    # Страницы готовятся в фоне, чтобы не задерживать запуск; до готовности они собираются по запросу
+    prerender_task = asyncio.create_task(prerender(app.state.db_pool))
     try:
         yield
     finally:
-        scheduler.shutdown()
+        prerender_task.cancel()
+        await cluster.stop()
+        await app.state.db_pool.close()
 
 async def refresh_data():
     print("Запуск обновления данных")
-    await refresh_data_func()
-
-write_lock = asyncio.Lock()
+    await refresh_coordinator.run(app.state.db_pool, "cron")
 
-if sys.platform.startswith("win") and sys.version_info >= (3, 12):
-    asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
-
-app = FastAPI(lifespan=lifespan)
+async def refresh_and_prerender(progress=None):
+    await refresh_data_func(progress=progress)
 
-app.mount("/static", StaticFiles(directory="static"), name="static")
+    # Сразу после записи данных готовим страницы нового поколения, чтобы запросы не ждали БД
+    if progress is not None:
+        await progress.start_stage("prerender")
+    rendered = await prerender(app.state.db_pool)
+    print(f"Страницы подготовлены: {rendered}")
 
-templates = Jinja2Templates(directory="templates")
+async def on_generation(generation: int):
+    # Данные обновил другой воркер или реплика: кэш уже сброшен, готовим страницы заново.
+    # Если обновление идёт в этом процессе, страницы подготовит refresh_and_prerender
+    if refresh_coordinator.current is not None:
+        return
+    print(f"Новое поколение данных: {generation}")
+    await prerender(app.state.db_pool)
 
-async def get_full_data(data_class: Data, request, car_name: str) -> dict:
-    total_clicks, total_impressions = await data_class.get_additional_information()
+# Обновление всегда выполняется в одном процессе среди воркеров и реплик: cron и /refresh
+# присоединяются к уже идущему запуску
+refresh_coordinator = RefreshCoordinator(refresh_and_prerender)
 
-    duration_graph, duration_graph_points = await data_class.chill_info("duration")
-    clicks_graph, clicks_graph_points = await data_class.chill_info("clicks")
+# Авто, которое открывается по адресу "/"
+HOME_VEHICLE = os.getenv("HOME_VEHICLE", "avatr")
 
-    events_graph, events_graph_points, events_by_date = await data_class.get_events()
+if sys.platform.startswith("win") and sys.version_info >= (3, 12):
+    asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
 
-    traffic_current_graph, traffic_current_graph_percent = await data_class.get_traffic(events_by_date)
-    traffic_all_graph, traffic_all_graph_percent = await data_class.get_traffic(events_by_date, is_all=True)
+app = FastAPI(lifespan=lifespan)
 
-    top_data_all = await data_class.get_top_info()
-    top_data = {k: v[0] for k, v in top_data_all.items()}
+app.mount("/static", StaticFiles(directory="static"), name="static")
 
-    full_data = {"impressions": total_impressions, "clicks": total_clicks, "top_data": top_data,
-            "clicks_graph": clicks_graph, "clicks_graph_points": clicks_graph_points,
-            "duration_graph": duration_graph, "duration_graph_points": duration_graph_points,
-            "events_graph": events_graph, "events_graph_points": events_graph_points,
-            "traffic_current_graph": traffic_current_graph, "traffic_current_graph_percent": traffic_current_graph_percent,
-            "traffic_all_graph": traffic_all_graph, "traffic_all_graph_percent": traffic_all_graph_percent}
+async def page_response(request: Request, car_name: str) -> Response:
+    body = await get_page_body(request.app.state.db_pool, car_name)
+    return conditional_response(request, body, media_type="text/html; charset=utf-8")
 
-    current_car_data = top_data_all[car_name.replace("-", "_")]
-    current_ctr = round(sum([price["ctr"] for price in current_car_data]) / len(current_car_data), 2)
-    current_cost_micros = round(sum([price['cost_micros'] for price in current_car_data]), 2)
-    current_average_cpc = round(sum([price["average_cpc"] for price in current_car_data]) / len(current_car_data), 2)
 
-    full_data["request"] = request
-    full_data["active_tab"] = car_name
-    full_data["page_ctr"] = current_ctr
-    full_data["page_cost_micros"] = current_cost_micros
-    full_data["page_average_cpc"] = current_average_cpc
+@app.get("/api/{vehicle}/dashboard")
+async def dashboard_api(request: Request, vehicle: str, exact: bool = False):
+    # exact=1 - все точки графиков и трафик за всё время без прореживания
+    if vehicle not in reference_data.get_vehicle_names():
+        raise HTTPException(status_code=404, detail="Авто не найдено")
+    body = await get_dashboard_body(request.app.state.db_pool, vehicle, exact=exact)
+    return conditional_response(request, body, media_type="application/json")
 
 
-    return full_data
+@app.get("/api/{vehicle}/traffic/{year}/{month}")
+async def traffic_month_api(request: Request, vehicle: str, year: int, month: int):
+    if vehicle not in reference_data.get_vehicle_names():
+        raise HTTPException(status_code=404, detail="Авто не найдено")
+    if not 1 <= month <= 12:
+        raise HTTPException(status_code=404, detail="Месяц не найден")
+    body = await get_traffic_month_body(request.app.state.db_pool, vehicle, year, month)
+    if body is None:
+        raise HTTPException(status_code=404, detail="Месяц не найден")
+    return conditional_response(request, body, media_type="application/json")
 
 
-@app.get("/refresh", response_class=HTMLResponse)
+@app.get("/refresh")
 async def refresh():
-    await refresh_data_func()
-    return "<h1>Refresh OK</h1>"
+    job, joined = await refresh_coordinator.trigger(app.state.db_pool, "manual")
+    return JSONResponse({**job, "joined_running": joined}, status_code=202)
+
+@app.get("/refresh/status")
+async def refresh_status():
+    job = await refresh_coordinator.get(app.state.db_pool)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Обновление ещё не запускалось")
+    return job
+
+@app.get("/refresh/{job_id}")
+async def refresh_job(job_id: str):
+    job = await refresh_coordinator.get(app.state.db_pool, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Задача обновления не найдена")
+    return job
+
+@app.get("/cache-stats")
+async def cache_stats():
+    return {**dashboard_cache.stats(), "ondemand": ondemand_cache.stats()}
 
 @app.get("/", response_class=HTMLResponse)
-async def avatr(request: Request):
-    data_class = Data()
-
-    car_name = "avatr"
-
-    data_class.data = await data_class.get_page_info(car_name=car_name)
-
-    full_data = await get_full_data(data_class, request=request, car_name=car_name)
-
-    return templates.TemplateResponse(
-        "index.html",
-        full_data
-    )
-
-
-@app.get("/electro", response_class=HTMLResponse)
-async def ag_electro(request: Request):
-    data_class = Data()
-
-    car_name = "electro"
-
-    data_class.data = await data_class.get_page_info(car_name=car_name)
-
-    full_data = await get_full_data(data_class, request=request, car_name=car_name)
-
-    return templates.TemplateResponse(
-        "index.html",
-        full_data
-    )
-
-
-@app.get("/bosh-service", response_class=HTMLResponse)
-async def bosh(request: Request):
-    data_class = Data()
-
-    car_name = "bosh-service"
-
-    data_class.data = await data_class.get_page_info(car_name=car_name)
-
-    full_data = await get_full_data(data_class, request=request, car_name=car_name)
-
-    return templates.TemplateResponse(
-        "index.html",
-        full_data
-    )
-
-
-@app.get("/autogroup-e-service", response_class=HTMLResponse)
-async def autogroup_e_service(request: Request):
-    data_class = Data()
-
-    car_name = "autogroup-e-service"
-
-    data_class.data = await data_class.get_page_info(car_name=car_name)
-
-    full_data = await get_full_data(data_class, request=request, car_name=car_name)
-
-    return templates.TemplateResponse(
-        "index.html",
-        full_data
-    )
-
-
-@app.get("/autogroup-used-cars", response_class=HTMLResponse)
-async def autogroup_used_cars(request: Request):
-    data_class = Data()
-
-    car_name = "autogroup-used-cars"
-
-    data_class.data = await data_class.get_page_info(car_name=car_name)
-
-    full_data = await get_full_data(data_class, request=request, car_name=car_name)
-
-    return templates.TemplateResponse(
-        "index.html",
-        full_data
-    )
-
-
-@app.get("/citroen", response_class=HTMLResponse)
-async def citroen(request: Request):
-    data_class = Data()
-
-    car_name = "citroen"
-
-    data_class.data = await data_class.get_page_info(car_name=car_name)
-
-    full_data = await get_full_data(data_class, request=request, car_name=car_name)
-
-    return templates.TemplateResponse(
-        "index.html",
-        full_data
-    )
-
-
-@app.get("/ds", response_class=HTMLResponse)
-async def ds(request: Request):
-    data_class = Data()
-
-    car_name = "ds"
-
-    data_class.data = await data_class.get_page_info(car_name=car_name)
-
-    full_data = await get_full_data(data_class, request=request, car_name=car_name)
-
-    return templates.TemplateResponse(
-        "index.html",
-        full_data
-    )
-
-
-@app.get("/ford", response_class=HTMLResponse)
-async def ford(request: Request):
-    data_class = Data()
-
-    car_name = "ford"
-
-    data_class.data = await data_class.get_page_info(car_name=car_name)
-
-    full_data = await get_full_data(data_class, request=request, car_name=car_name)
-
-    return templates.TemplateResponse(
-        "index.html",
-        full_data
-    )
-
-
-@app.get("/hyundai", response_class=HTMLResponse)
-async def hyundai(request: Request):
-    data_class = Data()
-
-    car_name = "hyundai"
-
-    data_class.data = await data_class.get_page_info(car_name=car_name)
-
-    full_data = await get_full_data(data_class, request=request, car_name=car_name)
-
-    return templates.TemplateResponse(
-        "index.html",
-        full_data
-    )
-
-
-@app.get("/kia", response_class=HTMLResponse)
-async def kia(request: Request):
-    data_class = Data()
-
-    car_name = "kia"
-
-    data_class.data = await data_class.get_page_info(car_name=car_name)
-
-    full_data = await get_full_data(data_class, request=request, car_name=car_name)
-
-    return templates.TemplateResponse(
-        "index.html",
-        full_data
-    )
-
-
-@app.get("/mg", response_class=HTMLResponse)
-async def mg(request: Request):
-    data_class = Data()
-
-    car_name = "mg"
-
-    data_class.data = await data_class.get_page_info(car_name=car_name)
-
-    full_data = await get_full_data(data_class, request=request, car_name=car_name)
-
-    return templates.TemplateResponse(
-        "index.html",
-        full_data
-    )
-
-
-@app.get("/mitsubishi", response_class=HTMLResponse)
-async def mitsubishi(request: Request):
-    data_class = Data()
-
-    car_name = "mitsubishi"
-
-    data_class.data = await data_class.get_page_info(car_name=car_name)
-
-    full_data = await get_full_data(data_class, request=request, car_name=car_name)
-
-    return templates.TemplateResponse(
-        "index.html",
-        full_data
-    )
-
-
-@app.get("/nissan", response_class=HTMLResponse)
-async def nissan(request: Request):
-    data_class = Data()
-
-    car_name = "nissan"
-
-    data_class.data = await data_class.get_page_info(car_name=car_name)
-
-    full_data = await get_full_data(data_class, request=request, car_name=car_name)
-
-    return templates.TemplateResponse(
-        "index.html",
-        full_data
-    )
-
-
-@app.get("/peugeot", response_class=HTMLResponse)
-async def peugeot(request: Request):
-    data_class = Data()
-
-    car_name = "peugeot"
-
-    data_class.data = await data_class.get_page_info(car_name=car_name)
-
-    full_data = await get_full_data(data_class, request=request, car_name=car_name)
-
-    return templates.TemplateResponse(
-        "index.html",
-        full_data
-    )
-
-
-@app.get("/renault", response_class=HTMLResponse)
-async def renault(request: Request):
-    data_class = Data()
-
-    car_name = "renault"
-
-    data_class.data = await data_class.get_page_info(car_name=car_name)
-
-    full_data = await get_full_data(data_class, request=request, car_name=car_name)
-
-    return templates.TemplateResponse(
-        "index.html",
-        full_data
-    )
-
-
-@app.get("/skoda", response_class=HTMLResponse)
-async def skoda(request: Request):
-    data_class = Data()
-
-    car_name = "skoda"
-
-    data_class.data = await data_class.get_page_info(car_name=car_name)
-
-    full_data = await get_full_data(data_class, request=request, car_name=car_name)
-
-    return templates.TemplateResponse(
-        "index.html",
-        full_data
-    )
-
-
-@app.get("/vag-service", response_class=HTMLResponse)
-async def vag_service(request: Request):
-    data_class = Data()
-
-    car_name = "vag-service"
-
-    data_class.data = await data_class.get_page_info(car_name=car_name)
-
-    full_data = await get_full_data(data_class, request=request, car_name=car_name)
-
-    return templates.TemplateResponse(
-        "index.html",
-        full_data
-    )
-
-
-@app.get("/autogroup-service", response_class=HTMLResponse)
-async def autogroup(request: Request):
-    data_class = Data()
-
-    car_name = "autogroup-service"
-
-    data_class.data = await data_class.get_page_info(car_name=car_name)
-
-    full_data = await get_full_data(data_class, request=request, car_name=car_name)
-
-    return templates.TemplateResponse(
-        "index.html",
-        full_data
-    )
-
-
-@app.get("/chery", response_class=HTMLResponse)
-async def chery(request: Request):
-    data_class = Data()
-
-    car_name = "chery"
-
-    data_class.data = await data_class.get_page_info(car_name=car_name)
-
-    full_data = await get_full_data(data_class, request=request, car_name=car_name)
-
-    return templates.TemplateResponse(
-        "index.html",
-        full_data
-    )
-
-@app.get("/lts", response_class=HTMLResponse)
-async def lts(request: Request):
-    data_class = Data()
-
-    car_name = "lts"
-
-    data_class.data = await data_class.get_page_info(car_name=car_name)
+async def home(request: Request):
+    return await page_response(request=request, car_name=HOME_VEHICLE)
 
-    full_data = await get_full_data(data_class, request=request, car_name=car_name)
 
-    return templates.TemplateResponse(
-        "index.html",
-        full_data
-    )
\ No newline at end of file
+# Страницы авто - по списку vehicle_name из target_names.json; маршрут регистрируется последним,
+# чтобы не перекрывать /refresh, /cache-stats и /api
+@app.get("/{vehicle}", response_class=HTMLResponse)
+async def vehicle_page(request: Request, vehicle: str):
+    if vehicle not in reference_data.get_vehicle_names():
+        raise HTTPException(status_code=404, detail="Авто не найдено")
+    return await page_response(request=request, car_name=vehicle)
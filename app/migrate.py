@@ -0,0 +1,56 @@
+import argparse
+import asyncio
+from typing import List, Optional
+
+from get_google_data import SQL, logger, schema_cache
+from reference_data import reference_data
+
+
+async def migrate(vehicles: Optional[List[str]] = None, drop_old: bool = False) -> None:
+    """
+    Перенос старых отдельных таблиц авто (avatr, kia, ...) в общую таблицу daily_metrics.
+    Каждое авто переносится в своей транзакции; повторный запуск безопасен (upsert по (vehicle_id, date)).
+    """
+    sql = SQL()
+    await sql.create_conn()
+
+    tables = [v.replace("-", "_") for v in vehicles] if vehicles else reference_data.get_vehicle_tables()
+    try:
+        async with sql.pool.acquire() as conn:
+            if not await sql.has_table(conn, "companies"):
+                logger.info("Таблица companies не найдена - переносить нечего")
+                return
+            await sql.ensure_daily_metrics(conn)
+
+            for table_name in tables:
+                if not await sql.has_table(conn, table_name):
+                    continue
+
+                months = await conn.fetch(f"SELECT DISTINCT date_trunc('month', date)::date AS month FROM {table_name};")
+                await sql.ensure_partitions(conn, [row["month"] for row in months])
+
+                async with conn.transaction():
+                    rows = await sql.migrate_vehicle_table(conn, table_name)
+                    if drop_old:
+                        await conn.execute(f"DROP TABLE {table_name};")
+                if drop_old:
+                    schema_cache.discard_table(table_name)
+                logger.info(f'Таблица "{table_name}" перенесена в daily_metrics: {rows} строк')
+
+            # Сводка KPI пересчитывается целиком по новой таблице
+            await sql.ensure_kpi_summary(conn)
+            await sql.refresh_kpi_summary(conn, None)
+    finally:
+        await sql.close()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Перенос таблиц авто в daily_metrics")
+    parser.add_argument("--vehicles", nargs="*", help="vehicle_name из target_names.json (по умолчанию все)")
+    parser.add_argument("--drop-old", action="store_true", help="удалить старые таблицы после переноса")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    asyncio.run(migrate(vehicles=args.vehicles, drop_old=args.drop_old))
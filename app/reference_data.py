@@ -0,0 +1,124 @@
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+from dotenv import load_dotenv
+load_dotenv()
+
+
+class ReferenceData:
+    """
+    Справочники из data_files (month.json, target_names.json, analytic_accounts.json).
+    Файлы читаются один раз, индексы строятся при загрузке. Повторно файл читается
+    только если изменилось его mtime (проверка не чаще раза в check_interval секунд).
+    """
+    def __init__(self, check_interval: float = 5.0):
+        self.files = {
+            "months": "MONTH_FILE",
+            "targets": "TARGET_NAMES_FILE",
+            "analytic_accounts": "ANALYTIC_ACCOUNTS_FILE",
+        }
+        self.check_interval = check_interval
+
+        self._data: Dict[str, Any] = {}
+        self._mtimes: Dict[str, float] = {}
+        self._last_check = 0.0
+
+        self.target_by_campaign: Dict[str, dict] = {}
+        self.vehicle_tables: List[str] = []
+        self.vehicle_names: List[str] = []
+        # Увеличивается при каждой перезагрузке target_names.json - по нему сбрасываются зависимые кэши
+        self.targets_version = 0
+
+    def load(self) -> None:
+        for name in self.files:
+            self._load_file(name)
+        self._last_check = time.monotonic()
+
+    def _path(self, name: str) -> str:
+        env_name = self.files[name]
+        path = os.getenv(env_name)
+        if not path:
+            raise RuntimeError(f"{env_name} env var is not set")
+        return path
+
+    def _load_file(self, name: str) -> None:
+        path = self._path(name)
+        try:
+            # Файл может ненадолго пропасть (выкладка, атомарное сохранение редактором)
+            mtime = os.stat(path).st_mtime
+            if self._mtimes.get(name) == mtime:
+                return
+            with open(path, mode="r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            # Битый файл не должен ронять приложение, если старая версия уже загружена
+            if name not in self._data:
+                raise
+            print(f"Ошибка перечитывания справочника {path}: {e}")
+            return
+
+        self._data[name] = data
+        self._mtimes[name] = mtime
+        if name == "targets":
+            self._build_target_index(data)
+
+    def _build_target_index(self, targets: list) -> None:
+        target_by_campaign = {}
+        vehicle_tables = []
+        vehicle_names = []
+        for target in targets:
+            if not isinstance(target, dict) or not target.get("vehicle_name"):
+                continue
+            vehicle_names.append(target["vehicle_name"])
+            vehicle_tables.append(target["vehicle_name"].replace("-", "_"))
+            # Первое совпадение имеет приоритет, как при прежнем линейном поиске
+            for key in ("vehicle_name", "ads_target", "analyst_target"):
+                if target.get(key):
+                    target_by_campaign.setdefault(target[key], target)
+
+        self.target_by_campaign = target_by_campaign
+        self.vehicle_tables = vehicle_tables
+        self.vehicle_names = vehicle_names
+        self.targets_version += 1
+
+    def _get(self, name: str) -> Any:
+        now = time.monotonic()
+        if name not in self._data:
+            self._load_file(name)
+        elif now - self._last_check >= self.check_interval:
+            self._last_check = now
+            for file_name in self.files:
+                self._load_file(file_name)
+        return self._data[name]
+
+    @property
+    def months(self) -> Dict[str, str]:
+        return self._get("months")
+
+    @property
+    def targets(self) -> List[dict]:
+        return self._get("targets")
+
+    @property
+    def analytic_accounts(self) -> List[dict]:
+        return self._get("analytic_accounts")
+
+    def get_vehicle_tables(self) -> List[str]:
+        self._get("targets")
+        return self.vehicle_tables
+
+    def get_vehicle_names(self) -> List[str]:
+        """
+        vehicle_name как в адресах страниц (avatr, bosh-service, ...).
+        """
+        self._get("targets")
+        return self.vehicle_names
+
+    def find_target(self, campaign_name: str) -> Optional[dict]:
+        self._get("targets")
+        return self.target_by_campaign.get(campaign_name)
+
+
+reference_data = ReferenceData(check_interval=float(os.getenv("REFERENCE_DATA_CHECK_INTERVAL", "5")))
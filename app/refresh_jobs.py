@@ -0,0 +1,154 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+import asyncpg
+
+from cluster import REFRESH_LOCK_ID
+from get_google_data import SQL
+
+# Сколько раз /refresh ищет запуск другого процесса, пока тот берёт блокировку и записывает задачу
+JOIN_ATTEMPTS = int(os.getenv("REFRESH_JOIN_ATTEMPTS", "10"))
+JOIN_RETRY_SECONDS = float(os.getenv("REFRESH_JOIN_RETRY_SECONDS", "0.2"))
+
+
+class RefreshJob:
+    """
+    Запуск обновления в процессе, который его выполняет: текущий этап и длительность каждого этапа
+    пишутся в refresh_jobs по соединению, на котором держится блокировка REFRESH_LOCK_ID.
+    """
+    def __init__(self, trigger: str, conn: asyncpg.Connection, sql: SQL):
+        self.id = uuid.uuid4().hex[:12]
+        self.trigger = trigger
+        self.conn = conn
+        self.sql = sql
+        self.current_stage: Optional[str] = None
+        self.stages: Dict[str, Optional[float]] = {}
+
+        self._stage_started: Optional[float] = None
+
+    def _close_stage(self) -> None:
+        if self.current_stage is not None and self._stage_started is not None:
+            self.stages[self.current_stage] = round(time.monotonic() - self._stage_started, 3)
+
+    async def start_stage(self, name: str) -> None:
+        self._close_stage()
+        self.current_stage = name
+        self.stages[name] = None
+        self._stage_started = time.monotonic()
+        await self._save("running")
+
+    async def finish(self, error: Optional[str] = None) -> None:
+        self._close_stage()
+        self.current_stage = None
+        await self._save("failed" if error else "done", error)
+
+    async def _save(self, status: str, error: Optional[str] = None) -> None:
+        try:
+            await self.sql.update_refresh_job(self.conn, self.id, status, error, self.current_stage, self.stages)
+        except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+            # Ошибка записи состояния не должна прерывать само обновление
+            print(f"Ошибка записи состояния обновления ({self.id}): {e}")
+
+    async def close(self) -> None:
+        # Закрытие соединения снимает блокировку - следующее обновление может запустить любой процесс
+        if not self.conn.is_closed():
+            await self.conn.close()
+
+
+def job_to_dict(row: asyncpg.Record) -> Dict[str, Any]:
+    finished_at = row["finished_at"]
+    return {
+        "job_id": row["job_id"],
+        "trigger": row["trigger"],
+        "status": row["status"],
+        "error": row["error"],
+        "started_at": row["started_at"].isoformat(),
+        "finished_at": finished_at.isoformat() if finished_at is not None else None,
+        "seconds": round(((finished_at or datetime.now(timezone.utc)) - row["started_at"]).total_seconds(), 3),
+        "current_stage": row["current_stage"],
+        "stages": json.loads(row["stages"]),
+        "joined": row["joined"],
+    }
+
+
+class RefreshCoordinator:
+    """
+    Одно обновление на все воркеры и реплики: его выполняет процесс, который взял advisory lock
+    REFRESH_LOCK_ID, а состояние запуска хранится в таблице refresh_jobs. Вызовы (cron, /refresh)
+    в любом процессе во время обновления присоединяются к нему и получают его job_id.
+    """
+    def __init__(self, refresh_func: Callable[..., Awaitable[None]], history: int = 20):
+        self.refresh_func = refresh_func
+        self.history = history
+        self.dsn = os.getenv("DB_CONNECT")
+        self.sql = SQL()
+        self.current: Optional[RefreshJob] = None
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    async def _start(self, trigger: str) -> Optional[Dict[str, Any]]:
+        # Блокировка держится на отдельном соединении, а не на соединении из пула страниц
+        conn = await asyncpg.connect(dsn=self.dsn)
+        try:
+            if not await conn.fetchval("SELECT pg_try_advisory_lock($1);", REFRESH_LOCK_ID):
+                await conn.close()
+                return None
+            job = RefreshJob(trigger, conn, self.sql)
+            row = await self.sql.start_refresh_job(conn, REFRESH_LOCK_ID, job.id, trigger, self.history)
+        except BaseException:
+            await conn.close()
+            raise
+
+        self.current = job
+        self._task = asyncio.create_task(self._run(job))
+        return job_to_dict(row)
+
+    async def _run(self, job: RefreshJob) -> None:
+        try:
+            await self.refresh_func(progress=job)
+            await job.finish()
+        except Exception as e:
+            print(f"Ошибка обновления данных ({job.id}): {e}")
+            await job.finish(error=str(e))
+        finally:
+            self.current = None
+            self._task = None
+            await job.close()
+
+    async def trigger(self, pool: asyncpg.Pool, trigger: str) -> Tuple[Dict[str, Any], bool]:
+        """
+        Запускает обновление или присоединяется к уже выполняемому. Возвращает (задача, присоединился ли вызов).
+        """
+        for _ in range(JOIN_ATTEMPTS):
+            async with self._lock:
+                if self.current is None:
+                    job = await self._start(trigger)
+                    if job is not None:
+                        return job, False
+
+            async with pool.acquire() as conn:
+                row = await self.sql.join_refresh_job(conn, REFRESH_LOCK_ID)
+            if row is not None:
+                return job_to_dict(row), True
+            # Другой процесс уже взял блокировку, но ещё не записал задачу (или как раз её снимает)
+            await asyncio.sleep(JOIN_RETRY_SECONDS)
+        raise RuntimeError("Обновление выполняется в другом процессе, но его задача не найдена")
+
+    async def run(self, pool: asyncpg.Pool, trigger: str) -> Dict[str, Any]:
+        job, joined = await self.trigger(pool, trigger)
+        task = self._task
+        if not joined and task is not None:
+            await asyncio.shield(task)
+            return await self.get(pool, job["job_id"]) or job
+        return job
+
+    async def get(self, pool: asyncpg.Pool, job_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        # Без job_id - последний запуск
+        async with pool.acquire() as conn:
+            row = await self.sql.get_refresh_job(conn, REFRESH_LOCK_ID, job_id)
+        return job_to_dict(row) if row is not None else None
@@ -0,0 +1,193 @@
+import asyncio
+import os
+import re
+from datetime import date
+from typing import Optional
+
+import asyncpg
+import orjson
+from fastapi.templating import Jinja2Templates
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+
+from cache import dashboard_cache, ondemand_cache
+from data_transformation import Data
+from http_cache import CachedBody
+from reference_data import reference_data
+
+templates = Jinja2Templates(directory="templates")
+
+# Скомпилированные шаблоны сохраняются на диск и не компилируются заново после перезапуска
+# (без JINJA_CACHE_DIR - во временном каталоге системы)
+JINJA_CACHE_DIR = os.getenv("JINJA_CACHE_DIR")
+if JINJA_CACHE_DIR:
+    os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+templates.env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+
+# Метка активной вкладки в закэшированной панели брендов, подставляется для каждой страницы
+ACTIVE_MARKER = "%%active:{}%%"
+ACTIVE_MARKER_RE = re.compile(r"%%active:([\w-]+)%%")
+
+PRERENDER_CONCURRENCY = int(os.getenv("PRERENDER_CONCURRENCY", "4"))
+# Необязательный каталог, куда дополнительно пишутся готовые страницы и JSON (например, для nginx)
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR")
+
+
+async def get_top_data(pool: Optional[asyncpg.Pool]) -> dict:
+    # Панель брендов общая для всех страниц - одна запись кэша на поколение данных
+    top_data = dashboard_cache.get("top_data")
+    if top_data is None:
+        generation = dashboard_cache.generation
+        top_data = await Data(pool=pool).get_top_info()
+        dashboard_cache.set("top_data", top_data, generation=generation)
+    return top_data
+
+
+async def get_dashboard_body(pool: Optional[asyncpg.Pool], car_name: str, exact: bool = False) -> CachedBody:
+    # Данные меняются только после refresh_data_func, поэтому между обновлениями отдаём
+    # из кэша уже закодированный (и при необходимости сжатый) JSON; полная версия (exact) - в кэше запросов
+    cache = ondemand_cache if exact else dashboard_cache
+    key = ("dashboard", car_name, exact)
+    body = cache.get(key)
+    if body is None:
+        generation = cache.generation
+
+        data_class = Data(pool=pool)
+        await data_class.get_page_info(car_name=car_name)
+        dashboard = await data_class.get_dashboard(exact=exact)
+
+        current_car_data = (await get_top_data(pool))[car_name.replace("-", "_")]
+        dashboard["kpi"] = {
+            **dashboard.pop("totals"),
+            "ctr": round(current_car_data["month_ctr"], 2),
+            "cost_micros": round(current_car_data["month_cost_micros"], 2),
+            "average_cpc": round(current_car_data["month_average_cpc"], 2),
+        }
+        dashboard["vehicle"] = car_name
+        dashboard["month_names"] = reference_data.months
+
+        etag_key = f"api-{car_name}-exact" if exact else f"api-{car_name}"
+        body = CachedBody(orjson.dumps(dashboard), etag=cache.etag(etag_key, generation))
+        cache.set(key, body, generation=generation)
+
+    return body
+
+
+async def get_first_month(pool: Optional[asyncpg.Pool], car_name: str) -> Optional[date]:
+    # Первый месяц с данными авто - нижняя граница /api/{vehicle}/traffic/{year}/{month}
+    key = ("first_month", car_name)
+    first_month = ondemand_cache.get(key)
+    if first_month is None:
+        generation = ondemand_cache.generation
+        first_date = await Data(pool=pool).get_first_date(car_name)
+        # False - данных нет, запись кэша всё равно нужна
+        first_month = first_date.replace(day=1) if first_date is not None else False
+        ondemand_cache.set(key, first_month, generation=generation)
+    return first_month or None
+
+
+async def get_traffic_month_body(pool: Optional[asyncpg.Pool], car_name: str, year: int,
+                                 month: int) -> Optional[CachedBody]:
+    """
+    Точный трафик за месяц, которого нет в прореженном /api/{vehicle}/dashboard.
+    None - месяц вне периода данных авто (от первого месяца с данными до текущего).
+    """
+    first_month = await get_first_month(pool, car_name)
+    today = date.today()
+    if first_month is None or not (first_month.year, first_month.month) <= (year, month) <= (today.year, today.month):
+        return None
+
+    key = ("traffic", car_name, year, month)
+    body = ondemand_cache.get(key)
+    if body is None:
+        generation = ondemand_cache.generation
+
+        data_class = Data(pool=pool)
+        traffic = await data_class.get_traffic_month(car_name, year, month)
+
+        body = CachedBody(orjson.dumps(traffic), etag=ondemand_cache.etag(f"traffic-{car_name}-{year}-{month:02d}", generation))
+        ondemand_cache.set(key, body, generation=generation)
+
+    return body
+
+
+async def get_brand_strip(pool: Optional[asyncpg.Pool]) -> str:
+    """
+    Панель брендов одинакова на всех страницах, кроме активной вкладки: рендерится один раз
+    на поколение данных с метками ACTIVE_MARKER вместо класса active.
+    """
+    fragment = dashboard_cache.get("brand_strip")
+    if fragment is None:
+        generation = dashboard_cache.generation
+        top_data = await get_top_data(pool)
+        fragment = templates.get_template("brand_strip.html").render(
+            top_data=top_data, active_marker=ACTIVE_MARKER.format
+        )
+        dashboard_cache.set("brand_strip", fragment, generation=generation)
+    return fragment
+
+
+async def get_page_data(pool: Optional[asyncpg.Pool], car_name: str) -> dict:
+    # Графики и показатели страница загружает из /api/{vehicle}/dashboard, в HTML - только панель брендов
+    fragment = await get_brand_strip(pool)
+    brand_strip = ACTIVE_MARKER_RE.sub(lambda m: " active " if m.group(1) == car_name else "", fragment)
+    return {"brand_strip": Markup(brand_strip), "active_tab": car_name}
+
+
+async def get_page_body(pool: Optional[asyncpg.Pool], car_name: str) -> CachedBody:
+    body = dashboard_cache.get(("page", car_name))
+    if body is None:
+        generation = dashboard_cache.generation
+        full_data = await get_page_data(pool, car_name)
+        content = templates.get_template("index.html").render(full_data).encode("utf-8")
+        body = CachedBody(content, etag=dashboard_cache.etag(f"page-{car_name}", generation))
+        dashboard_cache.set(("page", car_name), body, generation=generation)
+    return body
+
+
+def write_snapshot(car_name: str, page: CachedBody, dashboard: CachedBody) -> None:
+    # Запись через временный файл, чтобы читатель не увидел недописанную страницу
+    # (у каждого воркера свой временный файл - каталог общий)
+    for file_name, body in ((f"{car_name}.html", page), (f"{car_name}.json", dashboard)):
+        path = os.path.join(SNAPSHOT_DIR, file_name)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(body.content)
+        os.replace(tmp_path, path)
+
+
+async def prerender(pool: Optional[asyncpg.Pool]) -> int:
+    """
+    Готовит страницы и JSON всех авто для текущего поколения данных (после обновления и при старте),
+    чтобы запросы сразу отдавались из памяти. Возвращает количество подготовленных авто.
+    """
+    vehicles = reference_data.get_vehicle_names()
+    if not vehicles:
+        return 0
+
+    # Общие для всех страниц данные готовятся один раз до параллельного рендера
+    await get_top_data(pool)
+    await get_brand_strip(pool)
+    if SNAPSHOT_DIR:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+
+    semaphore = asyncio.Semaphore(PRERENDER_CONCURRENCY)
+
+    async def render(car_name: str) -> bool:
+        async with semaphore:
+            try:
+                page = await get_page_body(pool, car_name)
+                dashboard = await get_dashboard_body(pool, car_name)
+
+                # Сжатие и запись на диск - вне цикла событий
+                await asyncio.to_thread(page.precompress)
+                await asyncio.to_thread(dashboard.precompress)
+                if SNAPSHOT_DIR:
+                    await asyncio.to_thread(write_snapshot, car_name, page, dashboard)
+            except Exception as e:
+                print(f"Ошибка подготовки страницы {car_name}: {e}")
+                return False
+        return True
+
+    results = await asyncio.gather(*(render(car_name) for car_name in vehicles))
+    return sum(results)